@@ -0,0 +1,423 @@
+import asyncio
+import collections
+import time
+import urllib.parse
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from allindb import blizzard
+from allindb import discord
+from allindb import ratelimit
+from allindb.firebase import WriteBatch
+from allindb.metrics import metrics
+
+MAX_IN_FLIGHT_PER_HOST = 64
+
+
+class AsyncHttpEngine:
+    def __init__(
+        self,
+        max_in_flight_per_host: int = MAX_IN_FLIGHT_PER_HOST,
+        game_data_url_template: str = None,
+        community_url_template: str = None,
+        discord_api_url: str = None,
+    ):
+        if aiohttp is None:
+            raise RuntimeError("aiohttp must be installed to use the asyncio engine")
+
+        self.max_in_flight_per_host = max_in_flight_per_host
+        self.game_data_url_template = (
+            game_data_url_template or blizzard.GAME_DATA_URL_TEMPLATE
+        )
+        self.community_url_template = (
+            community_url_template or blizzard.COMMUNITY_URL_TEMPLATE
+        )
+        self.discord_api_url = discord_api_url or discord.API_URL
+
+        self._sessions = {}
+        self._requests_per_host = collections.Counter()
+        self._request_finished = asyncio.Condition()
+        self._in_flight = {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    async def close(self):
+        sessions, self._sessions = self._sessions, {}
+        for session in sessions.values():
+            await session.close()
+
+    def _session_for_host(self, host: str):
+        if host not in self._sessions:
+            self._sessions[host] = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_in_flight_per_host)
+            )
+        return self._sessions[host]
+
+    def _limit_per_host(self) -> int:
+        # The threaded path's AIMD limit, scaled to this engine's per-host
+        # limit, so throttling slows both engines down alike.
+        concurrency = ratelimit.scheduler.concurrency
+        return max(
+            1,
+            int(self.max_in_flight_per_host * concurrency.limit / concurrency.maximum),
+        )
+
+    async def _acquire(self, host: str):
+        async with self._request_finished:
+            await self._request_finished.wait_for(
+                lambda: self._requests_per_host[host] < self._limit_per_host()
+            )
+            self._requests_per_host[host] += 1
+
+    async def _release(self, host: str):
+        # The limit only grows when a request finishes, so waiters are only
+        # woken here. The count is released first, in case this is cancelled.
+        self._requests_per_host[host] -= 1
+        async with self._request_finished:
+            self._request_finished.notify_all()
+
+    async def get_json(
+        self, url: str, route: str = None, headers: dict = None, allow_404=False
+    ):
+        return await self._get(
+            url, route, headers, allow_404, lambda x: x.json(content_type=None)
+        )
+
+    async def get_text(self, url: str, route: str = None, headers: dict = None):
+        return await self._get(url, route, headers, False, lambda x: x.text())
+
+    async def _get(self, url: str, route: str, headers: dict, allow_404: bool, read):
+        host = urllib.parse.urlsplit(url).netloc
+        route = route or host
+        session = self._session_for_host(host)
+
+        attempt = 0
+        while True:
+            await asyncio.sleep(ratelimit.scheduler.reserve(host, route))
+
+            error = None
+            retry_after = None
+            await self._acquire(host)
+            start = time.monotonic()
+            try:
+                async with session.get(url, headers=headers) as response:
+                    status = response.status
+                    metrics.observe(
+                        "http_request_seconds", route, time.monotonic() - start
+                    )
+                    metrics.increment(
+                        "http_requests_total", "{} {}".format(route, status)
+                    )
+                    retry_after = ratelimit.scheduler.observe(
+                        host, route, status, response.headers
+                    )
+                    if status == 200:
+                        return await read(response)
+                    if status == 404 and allow_404:
+                        return None
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                metrics.observe("http_request_seconds", route, time.monotonic() - start)
+                metrics.increment("http_requests_total", "{} error".format(route))
+                error = e
+            finally:
+                await self._release(host)
+
+            if error is None:
+                if status != 429 and status < 500:
+                    raise ratelimit.RequestError(url, status)
+                error = ratelimit.RequestError(url, status)
+
+            attempt += 1
+            if attempt >= ratelimit.scheduler.retries:
+                raise error
+
+            metrics.increment("http_retries_total", route)
+            await asyncio.sleep(ratelimit.scheduler.backoff(attempt, retry_after))
+
+    async def single_flight(self, key, create_coroutine):
+        future = self._in_flight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(create_coroutine())
+            self._in_flight[key] = future
+            future.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        return await asyncio.shield(future)
+
+    async def get_game_data(
+        self, access_token: str, region: str, path: str, route: str
+    ) -> dict:
+        url = self.game_data_url_template.format(region) + path
+        return await self.get_json(
+            url, route, headers={"Authorization": "Bearer " + access_token}
+        )
+
+    async def get_community(
+        self, access_token: str, region: str, path: str, route: str
+    ) -> dict:
+        url = self.community_url_template.format(region) + path
+        return await self.get_json(
+            url, route, headers={"Authorization": "Bearer " + access_token}
+        )
+
+
+async def get_league_data(
+    engine: AsyncHttpEngine,
+    access_token: str,
+    season: int,
+    league_id: int,
+    region: str = "us",
+) -> dict:
+    path = "/league/{}/201/0/{}".format(season, league_id)
+    return await engine.get_game_data(access_token, region, path, "league")
+
+
+async def get_ladder_data(
+    engine: AsyncHttpEngine, access_token: str, ladder_id: int, region: str = "us"
+) -> dict:
+    return await engine.get_game_data(
+        access_token, region, "/ladder/{}".format(ladder_id), "ladder"
+    )
+
+
+async def get_ladder_teams(
+    engine: AsyncHttpEngine,
+    access_token: str,
+    ladder_id: int,
+    region: str = "us",
+    league_id: int = 0,
+) -> list:
+    teams = blizzard.ladder_cache.peek(region, ladder_id)
+    if teams is not None:
+        return teams
+
+    async def fetch_teams() -> list:
+        url = engine.game_data_url_template.format(region) + "/ladder/{}".format(
+            ladder_id
+        )
+        body = await engine.get_text(
+            url, "ladder", headers={"Authorization": "Bearer " + access_token}
+        )
+        if blizzard.cpu_executor is None:
+            return blizzard.decode_ladder_teams(body, league_id)
+        return await asyncio.wrap_future(
+            blizzard.cpu_executor.submit(blizzard.decode_ladder_teams, body, league_id)
+        )
+
+    teams = await engine.single_flight(("ladder", region, str(ladder_id)), fetch_teams)
+    blizzard.ladder_cache.put(region, ladder_id, teams)
+    return teams
+
+
+async def get_legacy_profile_ladder_data(
+    engine: AsyncHttpEngine,
+    access_token: str,
+    profile_realm: str,
+    profile_id: str,
+    region: str,
+) -> dict:
+    path = "/legacy/profile/{}/{}/{}/ladders".format(
+        blizzard.REGION_IDS.get(region, 1), profile_realm, profile_id
+    )
+    return await engine.get_community(access_token, region, path, "legacy_profile")
+
+
+async def get_member_info(
+    engine: AsyncHttpEngine, bot_token: str, guild_id: str, member_id: str
+) -> dict:
+    url = "{}/guilds/{}/members/{}".format(engine.discord_api_url, guild_id, member_id)
+    try:
+        member_info = await engine.get_json(
+            url,
+            route="GET /guilds/{}/members/:id".format(guild_id),
+            headers={"Authorization": "Bot " + bot_token},
+            allow_404=True,
+        )
+    except (ratelimit.RequestError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+        print(e)
+        print("Failed to fetch member info for: " + member_id + ", skipping")
+        return {}
+
+    if member_info is None:
+        print("Unknown member: " + member_id)
+        return {}
+
+    return member_info
+
+
+async def _ignore_failure(coroutine, default):
+    # noinspection PyBroadException
+    try:
+        return await coroutine
+    except Exception as e:
+        blizzard.record_ignored_failure(e)
+        return default
+
+
+async def fetch_mmrs_and_clan_members_for_division(
+    engine: AsyncHttpEngine,
+    access_token: str,
+    ladder_id: int,
+    clan_ids: list,
+    player_index: blizzard.PlayerIndex,
+    mmr_distribution: blizzard.MmrDistribution,
+    region: str,
+    league_id: int,
+) -> list:
+    teams = await get_ladder_teams(engine, access_token, ladder_id, region, league_id)
+    return blizzard.extract_mmrs_and_clan_members(
+        teams, clan_ids, player_index, mmr_distribution, region, ladder_id
+    )
+
+
+async def fetch_mmrs_and_clan_members_for_each_region(
+    engine: AsyncHttpEngine,
+    access_tokens_per_region: dict,
+    current_season_id_per_region: dict,
+    clan_ids_per_region: dict,
+    player_index: blizzard.PlayerIndex,
+    league_ids: list,
+) -> (dict, dict):
+    regions = list(access_tokens_per_region.keys())
+    mmrs_per_region = dict((region, blizzard.MmrDistribution()) for region in regions)
+
+    async def fetch_league(region: str, league_id: int) -> list:
+        league_data = await get_league_data(
+            engine,
+            access_tokens_per_region[region],
+            current_season_id_per_region[region],
+            league_id,
+            region,
+        )
+        mmrs_per_region[region].tier_boundaries.add(
+            blizzard.extract_tier_boundaries(league_id, league_data)
+        )
+        return await asyncio.gather(
+            *(
+                fetch_mmrs_and_clan_members_for_division(
+                    engine,
+                    access_tokens_per_region[region],
+                    ladder_id,
+                    clan_ids_per_region.get(region, []),
+                    player_index,
+                    mmrs_per_region[region],
+                    region,
+                    league_id,
+                )
+                for ladder_id in blizzard.extract_ladder_ids(league_data)
+            )
+        )
+
+    results_per_league = await asyncio.gather(
+        *(
+            fetch_league(region, league_id)
+            for region in regions
+            for league_id in league_ids
+        )
+    )
+
+    clan_members_per_region = dict((region, []) for region in regions)
+    league_regions = (region for region in regions for _ in league_ids)
+    for region, results in zip(league_regions, results_per_league):
+        for clan_members in results:
+            clan_members_per_region[region].extend(clan_members)
+
+    for mmrs in mmrs_per_region.values():
+        mmrs.finalize()
+
+    return mmrs_per_region, clan_members_per_region
+
+
+async def _fetch_ladder_ids_from_profile(
+    engine: AsyncHttpEngine, access_token: str, region: str, character: str
+) -> (bool, list):
+    profile_id, profile_realm = blizzard.split_character_key(character)
+
+    profile_ladder_data = await _ignore_failure(
+        get_legacy_profile_ladder_data(
+            engine, access_token, profile_realm, profile_id, region
+        ),
+        {},
+    )
+    return blizzard.extract_ladder_ids_from_profile(profile_ladder_data)
+
+
+async def update_characters_for_member(
+    engine: AsyncHttpEngine,
+    access_tokens_per_region: dict,
+    current_season_id_per_region: dict,
+    mmrs_per_region: dict,
+    player_index: blizzard.PlayerIndex,
+    member_key: str,
+    member_data: dict,
+    batch: WriteBatch,
+    incremental: bool = False,
+):
+    battle_tag = member_data.get("battle_tag")
+    if not member_data.get("characters") or not battle_tag:
+        return
+
+    swept_updates, unswept_characters = blizzard.classify_characters(
+        player_index, current_season_id_per_region, member_data, incremental
+    )
+    blizzard.update_characters_ladder_stats(
+        current_season_id_per_region,
+        mmrs_per_region,
+        member_key,
+        swept_updates,
+        batch,
+    )
+
+    profiles = await asyncio.gather(
+        *(
+            _fetch_ladder_ids_from_profile(
+                engine, access_tokens_per_region[region], region, character
+            )
+            for region, character, _ in unswept_characters
+        )
+    )
+    ladder_keys = blizzard.unswept_ladder_keys(unswept_characters, profiles)
+    ladders = dict(
+        zip(
+            ladder_keys,
+            await asyncio.gather(
+                *(
+                    _ignore_failure(
+                        get_ladder_teams(
+                            engine, access_tokens_per_region[region], x, region
+                        ),
+                        None,
+                    )
+                    for region, x in ladder_keys
+                )
+            ),
+        )
+    )
+    blizzard.update_characters_ladder_stats(
+        current_season_id_per_region,
+        mmrs_per_region,
+        member_key,
+        blizzard.match_unswept_characters(
+            unswept_characters, profiles, ladders, battle_tag
+        ),
+        batch,
+    )
+
+
+async def update_discord_info_for_member(
+    engine: AsyncHttpEngine,
+    bot_token: str,
+    guild_id: str,
+    full_member_role_id: str,
+    member_key: str,
+    batch: WriteBatch,
+):
+    member_info = await get_member_info(engine, bot_token, guild_id, member_key)
+    discord.update_discord_info_from_member_info(
+        full_member_role_id, member_key, member_info, batch
+    )
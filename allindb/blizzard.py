@@ -1,242 +1,945 @@
+import array
 import bisect
+import collections
+import concurrent.futures
 import functools
+import heapq
 import itertools
+import json
+import threading
 import time
 import urllib.parse
-from typing import Tuple
+from typing import NamedTuple, Tuple
 
 from firebase_admin.db import reference
-import sc2gamedata
+import requests
+import requests.adapters
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from allindb import ratelimit
+from allindb.cache import LadderCache
+from allindb.httpcache import HttpCache
+from allindb.metrics import metrics
+from allindb.firebase import WriteBatch, join_path
 
 REGIONS = ["us", "eu", "kr"]
+REGION_IDS = {"us": 1, "eu": 2, "kr": 3}
+GAME_DATA_URL_TEMPLATE = "https://{}.api.blizzard.com/data/sc2"
+COMMUNITY_URL_TEMPLATE = "https://{}.api.blizzard.com/sc2"
+OAUTH_URL_TEMPLATE = "https://{}.battle.net/oauth/token"
+CONNECTION_POOL_SIZE = 64
+TOKEN_EXPIRY_MARGIN = 5 * 60
+SWEEP_CONCURRENCY_PER_REGION = 10
+
+ladder_cache = LadderCache()
+http_cache = None  # type: HttpCache
+cpu_executor = None  # type: concurrent.futures.Executor
+
+_session = requests.Session()
+_session.mount(
+    "https://",
+    requests.adapters.HTTPAdapter(
+        pool_connections=CONNECTION_POOL_SIZE, pool_maxsize=CONNECTION_POOL_SIZE
+    ),
+)
 
 
 def _flatten(l) -> list:
     return list(itertools.chain.from_iterable(l))
 
 
-def fetch_mmrs_and_clan_members_for_division(
-    access_token: str, ladder_id: int, clan_ids: list, league_id: int
-) -> (list, list):
-    ladder_data = sc2gamedata.get_ladder_data(access_token, ladder_id)
-    mmrs = [
-        team.get("rating") for team in ladder_data.get("team", []) if team.get("rating")
-    ]
+def _get(access_token: str, url: str, route: str) -> dict:
+    return json.loads(_get_text(access_token, url, route))
+
+
+def _get_text(access_token: str, url: str, route: str) -> str:
+    headers = {"Authorization": "Bearer " + access_token}
+
+    ttl = http_cache.ttl(route) if http_cache is not None else None
+    if ttl is None:
+        return ratelimit.scheduler.request(
+            _session, "GET", url, route=route, headers=headers
+        ).text
+
+    cached_response = http_cache.get(url)
+    if cached_response and cached_response.expires_at > time.time():
+        metrics.increment("http_cache_hits_total", route)
+        return cached_response.body
+
+    if cached_response and cached_response.etag:
+        headers["If-None-Match"] = cached_response.etag
+    if cached_response and cached_response.last_modified:
+        headers["If-Modified-Since"] = cached_response.last_modified
+
+    response = ratelimit.scheduler.request(
+        _session,
+        "GET",
+        url,
+        route=route,
+        passthrough_statuses=(304,),
+        headers=headers,
+    )
+
+    if response.status_code == 304 and cached_response:
+        metrics.increment("http_cache_revalidations_total", route)
+        http_cache.touch(url, time.time() + ttl)
+        return cached_response.body
+
+    http_cache.put(
+        url,
+        response.text,
+        time.time() + ttl,
+        response.headers.get("ETag"),
+        response.headers.get("Last-Modified"),
+    )
+    return response.text
+
+
+def _get_game_data(access_token: str, region: str, path: str, route: str) -> dict:
+    return _get(access_token, GAME_DATA_URL_TEMPLATE.format(region) + path, route)
 
-    clan_members = [
-        {**team, "league_id": league_id}
+
+def _get_community(access_token: str, region: str, path: str, route: str) -> dict:
+    return _get(access_token, COMMUNITY_URL_TEMPLATE.format(region) + path, route)
+
+
+def get_access_token(
+    client_id: str, client_secret: str, region: str
+) -> Tuple[str, float]:
+    response = ratelimit.scheduler.request(
+        _session,
+        "POST",
+        OAUTH_URL_TEMPLATE.format(region),
+        route="token",
+        data={"grant_type": "client_credentials"},
+        auth=(client_id, client_secret),
+    )
+    response_data = response.json()
+    access_token = response_data["access_token"]
+    expires_at = time.time() + response_data["expires_in"]
+
+    return access_token, expires_at
+
+
+def get_current_season_data(access_token: str, region: str = "us") -> dict:
+    return _get_game_data(access_token, region, "/season/current", "season")
+
+
+def get_league_data(
+    access_token: str, season: int, league_id: int, region: str = "us"
+) -> dict:
+    path = "/league/{}/201/0/{}".format(season, league_id)
+    return _get_game_data(access_token, region, path, "league")
+
+
+def get_legacy_profile_ladder_data(
+    access_token: str, profile_realm: str, profile_id: str, region: str
+) -> dict:
+    path = "/legacy/profile/{}/{}/{}/ladders".format(
+        REGION_IDS.get(region, 1), profile_realm, profile_id
+    )
+    return _get_community(access_token, region, path, "legacy_profile")
+
+
+def get_ladder_data(access_token: str, ladder_id: int, region: str = "us") -> dict:
+    return _get_game_data(
+        access_token, region, "/ladder/{}".format(ladder_id), "ladder"
+    )
+
+
+def get_ladder_teams(
+    access_token: str, ladder_id: int, region: str = "us", league_id: int = 0
+) -> list:
+    def fetch_teams() -> list:
+        body = _get_text(
+            access_token,
+            GAME_DATA_URL_TEMPLATE.format(region) + "/ladder/{}".format(ladder_id),
+            "ladder",
+        )
+        # Decoding a ladder is the heaviest CPU work in a run, so it is
+        # handed to cpu_executor's processes when there are some.
+        if cpu_executor is None:
+            return decode_ladder_teams(body, league_id)
+        return cpu_executor.submit(decode_ladder_teams, body, league_id).result()
+
+    return ladder_cache.get(region, ladder_id, fetch_teams)
+
+
+def decode_ladder_teams(body: str, league_id: int = 0) -> list:
+    return parse_ladder_teams(json.loads(body), league_id)
+
+
+class LadderTeam(NamedTuple):
+    character_key: str
+    battle_tag: str
+    race: str
+    clan_id: int
+    league_id: int
+    rating: int
+    wins: int
+    losses: int
+    ties: int
+    current_win_streak: int
+    longest_win_streak: int
+    last_played_time_stamp: int
+
+
+def parse_ladder_teams(ladder_data: dict, league_id: int = 0) -> list:
+    # Only these fields of a ladder are ever used, so the raw payload is
+    # dropped as soon as it has been parsed.
+    league_id = (
+        ladder_data.get("league", {}).get("league_key", {}).get("league_id", league_id)
+    )
+    return [
+        LadderTeam(
+            _gen_character_key(team),
+            _get_battle_tag(team),
+            _get_race(team),
+            _get_clan_id(team),
+            league_id,
+            team.get("rating", 0),
+            team.get("wins", 0),
+            team.get("losses", 0),
+            team.get("ties", 0),
+            team.get("current_win_streak", 0),
+            team.get("longest_win_streak", 0),
+            team.get("last_played_time_stamp", 0),
+        )
         for team in ladder_data.get("team", [])
-        if team.get("member", [])
-        and team["member"][0].get("clan_link", {}).get("id", 0) in clan_ids
     ]
 
-    return mmrs, clan_members
 
+def _profile_key(character_key: str) -> tuple:
+    # Profile id and realm, without the name, which changes on a rename.
+    return tuple(character_key.split("-", 2)[:2])
+
+
+class PlayerIndex:
+    def __init__(self):
+        self._teams_per_profile = collections.defaultdict(list)
+        self._lock = threading.Lock()
+
+    # Teams are kept with the ladder they were found on, so a later pass can
+    # refetch just the ladders of the players it cares about.
+    def add_teams(self, region: str, teams: list, ladder_id: int = None):
+        with self._lock:
+            for team in teams:
+                if not team.race or not team.character_key:
+                    continue
+                self._teams_per_profile[
+                    (region,) + _profile_key(team.character_key)
+                ].append((ladder_id, team))
+
+    def teams(self) -> list:
+        with self._lock:
+            return [
+                (region, team, ladder_id)
+                for (region, _, _), teams in self._teams_per_profile.items()
+                for ladder_id, team in teams
+            ]
+
+    def find(self, region: str, character_key: str) -> list:
+        with self._lock:
+            return [
+                team
+                for _, team in self._teams_per_profile.get(
+                    (region,) + _profile_key(character_key), []
+                )
+            ]
+
+    def ladder_ids(self, region: str, character_key: str) -> list:
+        with self._lock:
+            return [
+                ladder_id
+                for ladder_id, _ in self._teams_per_profile.get(
+                    (region,) + _profile_key(character_key), []
+                )
+                if ladder_id is not None
+            ]
+
+
+def extract_ladder_ids(league_data: dict) -> list:
+    tiers = league_data.get("tier", [])
+    divisions = _flatten(tier.get("division", []) for tier in tiers)
+    return [
+        division["ladder_id"] for division in divisions if division.get("ladder_id")
+    ]
+
+
+def extract_tier_boundaries(league_id: int, league_data: dict) -> list:
+    # The API lists a league's top tier first; tiers are numbered from the
+    # bottom, three to a league.
+    return [
+        {
+            "type": "boundary",
+            "tier": (league_id * 3) + tier_index,
+            "min_mmr": tier_data.get("min_rating", 0),
+            "max_mmr": tier_data.get("max_rating", 99999),
+        }
+        for tier_index, tier_data in enumerate(reversed(league_data.get("tier", [])))
+    ]
+
+
+class TierBoundaries:
+    def __init__(self, boundaries: list = ()):
+        self._boundaries = {}
+        self._min_mmrs = []
+        self._tiers = []
+        self._lock = threading.Lock()
+        self.add(boundaries)
+
+    def __len__(self):
+        return len(self._boundaries)
+
+    def add(self, boundaries: list):
+        with self._lock:
+            for boundary in boundaries:
+                self._boundaries[boundary["tier"]] = boundary
+            lookup = sorted(
+                (boundary["min_mmr"], tier)
+                for tier, boundary in self._boundaries.items()
+            )
+            self._min_mmrs = [min_mmr for min_mmr, _ in lookup]
+            self._tiers = [tier for _, tier in lookup]
+
+    def tier(self, mmr: int) -> int:
+        if not self._tiers:
+            return None
+        index = bisect.bisect_right(self._min_mmrs, mmr) - 1
+        return self._tiers[max(index, 0)]
+
+    def tiers(self, mmrs: list) -> list:
+        return [self.tier(mmr) for mmr in mmrs]
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return dict(
+                (str(tier), boundary) for tier, boundary in self._boundaries.items()
+            )
 
-def fetch_mmrs_and_clan_members_for_each_league(
+
+class MmrDistribution:
+    def __init__(self, mmrs=(), tier_boundaries: TierBoundaries = None):
+        self._mmrs = array.array("i", mmrs)
+        self._is_sorted = False
+        self._lock = threading.Lock()
+        self.tier_boundaries = (
+            TierBoundaries() if tier_boundaries is None else tier_boundaries
+        )
+
+    def __len__(self):
+        return len(self._mmrs)
+
+    def to_list(self) -> list:
+        with self._lock:
+            return self._mmrs.tolist()
+
+    def extend(self, mmrs):
+        with self._lock:
+            self._mmrs.extend(mmrs)
+            self._is_sorted = False
+
+    def finalize(self):
+        with self._lock:
+            if self._is_sorted:
+                return
+            if numpy is not None:
+                numpy.frombuffer(self._mmrs, dtype=numpy.int32).sort()
+            else:
+                self._mmrs = array.array("i", sorted(self._mmrs))
+            self._is_sorted = True
+
+    def percentiles(self, mmrs: list) -> list:
+        self.finalize()
+        if not self._mmrs:
+            return [100.0] * len(mmrs)
+        if numpy is None:
+            return [calculate_percentile(mmr, self._mmrs) for mmr in mmrs]
+
+        sorted_mmrs = numpy.frombuffer(self._mmrs, dtype=numpy.int32)
+        ranks = numpy.searchsorted(sorted_mmrs, numpy.asarray(mmrs), side="right")
+        return (100.0 * (1 - ranks / len(sorted_mmrs))).tolist()
+
+    def tiers(self, mmrs: list) -> list:
+        return self.tier_boundaries.tiers(mmrs)
+
+
+def extract_mmrs_and_clan_members(
+    teams: list,
+    clan_ids: list,
+    player_index: PlayerIndex,
+    mmr_distribution: MmrDistribution,
+    region: str,
+    ladder_id: int = None,
+) -> list:
+    player_index.add_teams(region, teams, ladder_id)
+    mmr_distribution.extend(team.rating for team in teams if team.rating)
+    return [team for team in teams if team.clan_id in clan_ids]
+
+
+def fetch_mmrs_and_clan_members_for_division(
+    access_token: str,
+    ladder_id: int,
+    clan_ids: list,
+    player_index: PlayerIndex,
+    mmr_distribution: MmrDistribution,
+    region: str,
+    league_id: int,
+) -> list:
+    teams = get_ladder_teams(access_token, ladder_id, region, league_id)
+    return extract_mmrs_and_clan_members(
+        teams, clan_ids, player_index, mmr_distribution, region, ladder_id
+    )
+
+
+def fetch_mmrs_and_clan_members_for_each_region(
+    executor,
     access_tokens_per_region: dict,
     current_season_id_per_region: dict,
     clan_ids_per_region: dict,
-    league_id: int,
+    player_index: PlayerIndex,
+    league_ids: list,
+    concurrency_per_region: int = SWEEP_CONCURRENCY_PER_REGION,
+    on_region_complete=None,
 ) -> (dict, dict):
-    access_token = access_tokens_per_region["us"]
-    current_season_id = current_season_id_per_region["us"]
-    clan_ids = clan_ids_per_region.get("us", [])
-    league_data = sc2gamedata.get_league_data(
-        access_token, current_season_id, league_id
-    )
-    tiers = league_data.get("tier", [])
-    divisions = [tier.get("division", []) for tier in tiers]
-    flattened_divisions = _flatten(divisions)
-    mmrs, clan_members = zip(
-        *(
-            fetch_mmrs_and_clan_members_for_division(
-                access_token, division["ladder_id"], clan_ids, league_id
+    regions = list(access_tokens_per_region.keys())
+    mmrs_per_region = dict((region, MmrDistribution()) for region in regions)
+    clan_members_per_region = dict((region, []) for region in regions)
+
+    # Each region's requests are queued here and only submitted while fewer
+    # than concurrency_per_region of them are in flight, so a busy region
+    # never ties up pool threads that another region's requests could use.
+    queued_per_region = dict((region, collections.deque()) for region in regions)
+    in_flight_per_region = collections.Counter()
+    tasks = {}
+    pending = set()
+
+    # A region is finished once its leagues and all of their divisions are,
+    # at which point its distribution and player index entries are final and
+    # callers can start on that region while the others are still sweeping.
+    outstanding_per_region = collections.Counter()
+
+    def enqueue(region: str, league_id: int, is_league: bool, func, *args):
+        queued_per_region[region].append((league_id, is_league, func, args))
+        outstanding_per_region[region] += 1
+
+    def submit_queued(region: str):
+        queued = queued_per_region[region]
+        while queued and in_flight_per_region[region] < concurrency_per_region:
+            league_id, is_league, func, args = queued.popleft()
+            future = executor.submit(func, *args)
+            tasks[future] = (region, league_id, is_league)
+            pending.add(future)
+            in_flight_per_region[region] += 1
+
+    for region in regions:
+        for league_id in league_ids:
+            enqueue(
+                region,
+                league_id,
+                True,
+                get_league_data,
+                access_tokens_per_region[region],
+                current_season_id_per_region[region],
+                league_id,
+                region,
             )
-            for division in flattened_divisions
-            if division.get("ladder_id")
+        submit_queued(region)
+
+    while pending:
+        done, _ = concurrent.futures.wait(
+            pending, return_when=concurrent.futures.FIRST_COMPLETED
         )
-    )
-    return {"us": _flatten(mmrs)}, {"us": _flatten(clan_members)}
+        for future in done:
+            pending.remove(future)
+            region, league_id, is_league = tasks.pop(future)
+            in_flight_per_region[region] -= 1
+            if is_league:
+                league_data = future.result()
+                mmrs_per_region[region].tier_boundaries.add(
+                    extract_tier_boundaries(league_id, league_data)
+                )
+                for ladder_id in extract_ladder_ids(league_data):
+                    enqueue(
+                        region,
+                        league_id,
+                        False,
+                        fetch_mmrs_and_clan_members_for_division,
+                        access_tokens_per_region[region],
+                        ladder_id,
+                        clan_ids_per_region.get(region, []),
+                        player_index,
+                        mmrs_per_region[region],
+                        region,
+                        league_id,
+                    )
+            else:
+                clan_members_per_region[region].extend(future.result())
+            submit_queued(region)
+
+            outstanding_per_region[region] -= 1
+            if not outstanding_per_region[region]:
+                mmrs_per_region[region].finalize()
+                if on_region_complete:
+                    on_region_complete(
+                        region, mmrs_per_region[region], clan_members_per_region[region]
+                    )
+
+    return mmrs_per_region, clan_members_per_region
 
 
 def calculate_percentile(mmr: int, mmrs: list) -> float:
     return 100.0 * (1 - bisect.bisect(mmrs, mmr) / len(mmrs)) if mmrs else 100.0
 
 
-def get_access_token_and_current_season_per_region(
-    client_id: str, client_secret: str
-) -> Tuple[dict, dict]:
-    access_tokens_per_region = dict(
-        (region, sc2gamedata.get_access_token(client_id, client_secret, region)[0])
-        for region in REGIONS
+def update_matching_discord_member_ladder_stats(
+    discord_id: str,
+    region: str,
+    character: str,
+    season: str,
+    team: LadderTeam,
+    percentile: float,
+    batch: WriteBatch,
+    tier: int = None,
+):
+    data = _ladder_stats(team, percentile, tier)
+    batch.set(
+        join_path(
+            "members",
+            discord_id,
+            "characters",
+            region,
+            character,
+            "ladder_info",
+            season,
+            team.race,
+        ),
+        data,
+    )
+
+
+def _ladder_stats(team: LadderTeam, percentile: float, tier: int = None) -> dict:
+    stats = {
+        "league_id": team.league_id,
+        "wins": team.wins,
+        "losses": team.losses,
+        "ties": team.ties,
+        "games_played": team.wins + team.losses + team.ties,
+        "mmr": team.rating,
+        "current_win_streak": team.current_win_streak,
+        "longest_win_streak": team.longest_win_streak,
+        "last_played_time_stamp": team.last_played_time_stamp,
+        "percentile": percentile,
+    }
+    if tier is not None:
+        stats["tier"] = tier
+    return stats
+
+
+def _fingerprint(stats: dict) -> tuple:
+    return (
+        stats.get("last_played_time_stamp"),
+        stats.get("wins"),
+        stats.get("losses"),
+        stats.get("ties"),
     )
 
-    current_season_id_per_region = dict(
-        (
+
+def get_stored_season_data(character_data, current_season_id: int) -> dict:
+    if not isinstance(character_data, dict):
+        return {}
+    return character_data.get("ladder_info", {}).get(str(current_season_id)) or {}
+
+
+def is_unchanged(teams: list, stored_season_data: dict) -> bool:
+    fresh_fingerprints = dict(
+        (team.race, _fingerprint(team._asdict())) for team in teams
+    )
+    stored_fingerprints = dict(
+        (race, _fingerprint(race_data))
+        for race, race_data in stored_season_data.items()
+        if isinstance(race_data, dict)
+    )
+    return fresh_fingerprints == stored_fingerprints
+
+
+def _get_race(team: dict) -> str:
+    member_data = next(iter(team.get("member", [])), {})
+    played_race_count_data = next(iter(member_data.get("played_race_count", [])), {})
+    return next(iter(played_race_count_data.get("race", {}).values()), "")
+
+
+def _get_battle_tag(team: dict) -> str:
+    member_data = next(iter(team.get("member", [])), {})
+    return member_data.get("character_link", {}).get("battle_tag", "")
+
+
+def _get_clan_id(team: dict) -> int:
+    member_data = next(iter(team.get("member", [])), {})
+    return member_data.get("clan_link", {}).get("id", 0)
+
+
+def extract_ladder_ids_from_profile(profile_ladder_data: dict) -> Tuple[bool, list]:
+    current_season_data = profile_ladder_data.get("currentSeason", [])
+
+    current_season_ladders = [
+        x.get("ladder", [])[0] for x in current_season_data if x.get("ladder", [])
+    ]
+
+    ladder_ids = [
+        x.get("ladderId", "")
+        for x in current_season_ladders
+        if x.get("matchMakingQueue", "") == "LOTV_SOLO"
+    ]
+
+    return bool(current_season_data), ladder_ids
+
+
+def match_ladder_teams(ladders: list, character: str, battle_tag: str) -> list:
+    return [
+        team
+        for teams in ladders
+        for team in teams
+        if team.race
+        and (character == team.character_key or battle_tag == team.battle_tag)
+    ]
+
+
+def split_character_key(character: str) -> Tuple[str, str]:
+    munged_character = urllib.parse.quote(character.encode("utf8").decode("ISO-8859-1"))
+    profile_id, profile_realm, _ = munged_character.split("-")
+    return profile_id, profile_realm
+
+
+def _fetch_ladder_ids_from_profile(
+    access_token: str, region: str, character: str
+) -> Tuple[bool, list]:
+    profile_id, profile_realm = split_character_key(character)
+
+    profile_ladder_data = _ignore_failure(
+        functools.partial(
+            get_legacy_profile_ladder_data,
+            access_token,
+            profile_realm,
+            profile_id,
             region,
-            sc2gamedata.get_current_season_data(
-                access_tokens_per_region[region], region
-            )["id"],
-        )
-        for region in REGIONS
+        ),
+        {},
     )
+    return extract_ladder_ids_from_profile(profile_ladder_data)
 
-    return access_tokens_per_region, current_season_id_per_region
 
+def _fetch_ladder_teams_or_none(access_token: str, ladder_id, region: str) -> list:
+    return _ignore_failure(
+        functools.partial(get_ladder_teams, access_token, ladder_id, region), None
+    )
 
-def update_matching_discord_member_ladder_stats(
-    discord_id: str,
+
+def index_ladders(
+    executor: concurrent.futures.Executor,
+    access_tokens_per_region: dict,
+    ladder_keys: list,
+) -> PlayerIndex:
+    ladders = _fan_out(
+        executor,
+        lambda region, ladder_id: _fetch_ladder_teams_or_none(
+            access_tokens_per_region[region], ladder_id, region
+        ),
+        ladder_keys,
+    )
+
+    player_index = PlayerIndex()
+    for (region, ladder_id), teams in zip(ladder_keys, ladders):
+        if teams is not None:
+            player_index.add_teams(region, teams, ladder_id)
+    return player_index
+
+
+def _fan_out(executor: concurrent.futures.Executor, func, args_list: list) -> list:
+    # Only the calling thread waits on these tasks and they never wait on each
+    # other, so a pool of their own can't deadlock however busy it gets.
+    if executor is None or len(args_list) < 2:
+        return [func(*args) for args in args_list]
+    futures = [executor.submit(func, *args) for args in args_list]
+    return [future.result() for future in futures]
+
+
+def update_character_ladder_stats(
+    member_key: str,
     region: str,
     character: str,
-    season: str,
-    race: str,
-    ladder_data: dict,
-    team_data: dict,
-    mmrs: list,
+    current_season_id: int,
+    mmrs: MmrDistribution,
+    has_current_season: bool,
+    teams: list,
+    batch: WriteBatch,
+    stored_season_data: dict = None,
 ):
-    data = {
-        "league_id": ladder_data["league"]["league_key"]["league_id"],
-        "wins": team_data["wins"],
-        "losses": team_data["losses"],
-        "ties": team_data["ties"],
-        "games_played": team_data["wins"] + team_data["losses"] + team_data["ties"],
-        "mmr": team_data["rating"],
-        "current_win_streak": team_data["current_win_streak"],
-        "longest_win_streak": team_data["longest_win_streak"],
-        "last_played_time_stamp": team_data["last_played_time_stamp"],
-        "percentile": calculate_percentile(team_data["rating"], mmrs),
-    }
-    character_node = (
-        reference()
-        .child("members")
-        .child(discord_id)
-        .child("characters")
-        .child(region)
-        .child(character)
-    )
-    character_node.child("ladder_info").child(str(season)).child(race).set(data)
+    if stored_season_data is not None:
+        _update_changed_character_ladder_stats(
+            member_key,
+            region,
+            character,
+            current_season_id,
+            mmrs,
+            has_current_season,
+            teams,
+            batch,
+            stored_season_data,
+        )
+        return
 
+    if has_current_season:
+        batch.delete(
+            join_path(
+                "members",
+                member_key,
+                "characters",
+                region,
+                character,
+                "ladder_info",
+                current_season_id,
+            )
+        )
 
-def update_characters_for_member(
-    access_tokens_per_region: dict,
-    current_season_id_per_region: dict,
-    mmrs_per_region: dict,
+    ratings = [team.rating for team in teams]
+    for team, percentile, tier in zip(
+        teams, mmrs.percentiles(ratings), mmrs.tiers(ratings)
+    ):
+        update_matching_discord_member_ladder_stats(
+            member_key,
+            region,
+            character,
+            current_season_id,
+            team,
+            percentile,
+            batch,
+            tier,
+        )
+
+
+def _update_changed_character_ladder_stats(
     member_key: str,
+    region: str,
+    character: str,
+    current_season_id: int,
+    mmrs: MmrDistribution,
+    has_current_season: bool,
+    teams: list,
+    batch: WriteBatch,
+    stored_season_data: dict,
 ):
-    member_ref = reference().child("members").child(member_key)
-    characters_query_result = member_ref.child("characters").get()
-    battle_tag = member_ref.child("battle_tag").get()
+    season_path = join_path(
+        "members",
+        member_key,
+        "characters",
+        region,
+        character,
+        "ladder_info",
+        current_season_id,
+    )
 
-    if not characters_query_result or not battle_tag:
-        return
+    ratings = [team.rating for team in teams]
+    fresh_season_data = dict(
+        (team.race, _ladder_stats(team, percentile, tier))
+        for team, percentile, tier in zip(
+            teams, mmrs.percentiles(ratings), mmrs.tiers(ratings)
+        )
+    )
+
+    if has_current_season:
+        for race in stored_season_data.keys() - fresh_season_data.keys():
+            batch.delete(join_path(season_path, race))
 
+    for race, data in fresh_season_data.items():
+        stored_data = stored_season_data.get(race)
+        stored_data = stored_data if isinstance(stored_data, dict) else {}
+        changed_data = dict(
+            (key, value) for key, value in data.items() if stored_data.get(key) != value
+        )
+        if changed_data:
+            batch.update(join_path(season_path, race), changed_data)
+
+
+def classify_characters(
+    player_index: PlayerIndex,
+    current_season_id_per_region: dict,
+    member_data: dict,
+    incremental: bool = False,
+) -> (list, list):
+    # Splits a member's characters into updates that the sweep's teams are
+    # enough for, as (region, character, has_current_season, teams, stored
+    # season data), and characters whose teams have to be found through their
+    # legacy profile, as (region, character, stored season data).
+    characters_query_result = member_data.get("characters") or {}
+
+    swept_updates = []
+    unswept_characters = []
     for region in REGIONS:
-        access_token = access_tokens_per_region[region]
         current_season_id = current_season_id_per_region[region]
-        mmrs = mmrs_per_region.get(region, [])
 
         region_characters = characters_query_result.get(region, {})
-        for character in region_characters.keys():
-            munged_character = urllib.parse.quote(
-                character.encode("utf8").decode("ISO-8859-1")
-            )
-            profile_id, profile_realm, _ = munged_character.split("-")
-
-            profile_ladder_data = _ignore_failure(
-                functools.partial(
-                    sc2gamedata.get_legacy_profile_ladder_data,
-                    access_token,
-                    profile_realm,
-                    profile_id,
-                    region,
-                ),
-                {},
-            )
-            current_season_data = profile_ladder_data.get("currentSeason", [])
+        for character, character_data in region_characters.items():
+            teams = player_index.find(region, character)
 
-            if current_season_data:
-                characters_node = (
-                    reference().child("members").child(member_key).child("characters")
+            stored_season_data = None
+            if incremental:
+                stored_season_data = get_stored_season_data(
+                    character_data, current_season_id
                 )
-                characters_node.child(region).child(character).child(
-                    "ladder_info"
-                ).child(str(current_season_id)).delete()
-
-            current_season_ladders = [
-                x.get("ladder", [])[0]
-                for x in current_season_data
-                if x.get("ladder", [])
-            ]
+                # Missing from the index doesn't mean unranked: the character
+                # may have dropped out of the swept leagues, so only a hit is
+                # trusted and a miss still goes through the profile.
+                if teams and is_unchanged(teams, stored_season_data):
+                    continue
+
+            if teams:
+                swept_updates.append(
+                    (region, character, True, teams, stored_season_data)
+                )
+            else:
+                unswept_characters.append((region, character, stored_season_data))
 
-            ladder_ids = [
-                x.get("ladderId", "")
-                for x in current_season_ladders
-                if x.get("matchMakingQueue", "") == "LOTV_SOLO"
-            ]
+    return swept_updates, unswept_characters
 
-            ladders = [
-                _ignore_failure(
-                    functools.partial(
-                        sc2gamedata.get_ladder_data, access_token, x, region
-                    ),
-                    None,
-                )
-                for x in ladder_ids
-            ]
-            ladders = list(filter(None, ladders))
-
-            for ladder_data in ladders:
-                for team in ladder_data.get("team", {}):
-                    member_data = next(iter(team.get("member", [])), {})
-                    if not member_data.get("played_race_count"):
-                        continue
-
-                    def create_character_key_from_path(legacy_link_path: str):
-                        return (
-                            legacy_link_path[9:].replace("/", "-")
-                            if legacy_link_path
-                            else ""
-                        )
 
-                    legacy_link_path = member_data.get("legacy_link", {}).get(
-                        "path", ""
-                    )
-                    ladder_character_key = create_character_key_from_path(
-                        legacy_link_path
-                    )
-                    ladder_battle_tag = member_data.get("character_link", {}).get(
-                        "battle_tag", ""
-                    )
+def unswept_ladder_keys(unswept_characters: list, profiles: list) -> list:
+    # Characters on the same ladder share one fetch of it.
+    return list(
+        dict.fromkeys(
+            (region, ladder_id)
+            for (region, _, _), (_, ladder_ids) in zip(unswept_characters, profiles)
+            for ladder_id in ladder_ids
+        )
+    )
 
-                    if (
-                        character == ladder_character_key
-                        or battle_tag == ladder_battle_tag
-                    ):
-                        race = next(
-                            iter(member_data["played_race_count"][0]["race"].values()),
-                            "",
-                        )
 
-                        update_matching_discord_member_ladder_stats(
-                            member_key,
-                            region,
-                            character,
-                            current_season_id,
-                            race,
-                            ladder_data,
-                            team,
-                            mmrs,
-                        )
+def match_unswept_characters(
+    unswept_characters: list, profiles: list, ladders: dict, battle_tag: str
+) -> list:
+    return [
+        (
+            region,
+            character,
+            has_current_season,
+            match_ladder_teams(
+                list(filter(None, (ladders[(region, x)] for x in ladder_ids))),
+                character,
+                battle_tag,
+            ),
+            stored_season_data,
+        )
+        for (region, character, stored_season_data), (
+            has_current_season,
+            ladder_ids,
+        ) in zip(unswept_characters, profiles)
+    ]
 
 
-def update_ladder_summary_for_member(
-    current_season_id_per_region: dict, member_key: str
+def update_characters_ladder_stats(
+    current_season_id_per_region: dict,
+    mmrs_per_region: dict,
+    member_key: str,
+    updates: list,
+    batch: WriteBatch,
 ):
-    characters_query_result = (
-        reference().child("members").child(member_key).child("characters").get()
+    for region, character, has_current_season, teams, stored_season_data in updates:
+        update_character_ladder_stats(
+            member_key,
+            region,
+            character,
+            current_season_id_per_region[region],
+            mmrs_per_region.get(region, MmrDistribution()),
+            has_current_season,
+            teams,
+            batch,
+            stored_season_data,
+        )
+
+
+def update_characters_for_member(
+    access_tokens_per_region: dict,
+    current_season_id_per_region: dict,
+    mmrs_per_region: dict,
+    player_index: PlayerIndex,
+    member_key: str,
+    member_data: dict,
+    batch: WriteBatch,
+    incremental: bool = False,
+    fetch_executor: concurrent.futures.Executor = None,
+):
+    battle_tag = member_data.get("battle_tag")
+    if not member_data.get("characters") or not battle_tag:
+        return
+
+    swept_updates, unswept_characters = classify_characters(
+        player_index, current_season_id_per_region, member_data, incremental
+    )
+    update_characters_ladder_stats(
+        current_season_id_per_region,
+        mmrs_per_region,
+        member_key,
+        swept_updates,
+        batch,
     )
 
+    # Fall back to the legacy profile endpoint only for characters that the
+    # ladder sweep didn't see. Every character's profile is fetched at once,
+    # then every ladder those profiles list.
+    profiles = _fan_out(
+        fetch_executor,
+        _fetch_ladder_ids_from_profile,
+        [
+            (access_tokens_per_region[region], region, character)
+            for region, character, _ in unswept_characters
+        ],
+    )
+    ladder_keys = unswept_ladder_keys(unswept_characters, profiles)
+    ladders = dict(
+        zip(
+            ladder_keys,
+            _fan_out(
+                fetch_executor,
+                _fetch_ladder_teams_or_none,
+                [
+                    (access_tokens_per_region[region], ladder_id, region)
+                    for region, ladder_id in ladder_keys
+                ],
+            ),
+        )
+    )
+    update_characters_ladder_stats(
+        current_season_id_per_region,
+        mmrs_per_region,
+        member_key,
+        match_unswept_characters(unswept_characters, profiles, ladders, battle_tag),
+        batch,
+    )
+
+
+def _most_recent_seasons(seasons: dict, count: int) -> list:
+    # A character keeps every season it has played, so only the latest are
+    # picked out rather than sorting them all.
+    return heapq.nlargest(
+        count,
+        ((int(season), season_data) for season, season_data in seasons.items()),
+        key=lambda x: x[0],
+    )
+
+
+def update_ladder_summary_for_member(
+    current_season_id_per_region: dict,
+    member_key: str,
+    member_data: dict,
+    batch: WriteBatch,
+    incremental: bool = False,
+):
+    characters_query_result = member_data.get("characters")
+
     if not characters_query_result:
         return
 
@@ -257,18 +960,13 @@ def update_ladder_summary_for_member(
             seasons = character_data.get("ladder_info", {})
 
             if seasons:
-                two_most_recent_seasons = list(
-                    sorted(seasons.items(), key=lambda x: int(x[0]), reverse=True)
-                )[:2]
-
-                for season, season_data in two_most_recent_seasons:
+                for season_id, season_data in _most_recent_seasons(seasons, 2):
                     for race, race_data in season_data.items():
                         race_league = race_data["league_id"]
                         highest_league_per_race[race] = max(
                             highest_league_per_race[race], race_league
                         )
 
-                        season_id = int(season)
                         if season_id not in season_games_played:
                             season_games_played[season_id] = 0
                         season_games_played[season_id] += race_data["games_played"]
@@ -279,10 +977,11 @@ def update_ladder_summary_for_member(
                         ):
                             current_highest_league = race_league
 
+    highest_league = max(highest_league_per_race.values())
     highest_ranked_races = [
         race
         for race, league in highest_league_per_race.items()
-        if league == max(highest_league_per_race.values())
+        if league == highest_league
     ]
 
     data = {
@@ -300,7 +999,16 @@ def update_ladder_summary_for_member(
     if current_highest_league is not None:
         data["current_league"] = current_highest_league
 
-    reference().child("members").child(member_key).update(data)
+    if incremental:
+        data = dict(
+            (key, value)
+            for key, value in data.items()
+            if key == "last_updated" or member_data.get(key) != value
+        )
+        if len(data) == 1:
+            return
+
+    batch.update(join_path("members", member_key), data)
 
 
 def _gen_character_key(clan_member: dict) -> str:
@@ -311,81 +1019,126 @@ def _gen_character_key(clan_member: dict) -> str:
     return member_data.get("legacy_link", {}).get("path", "")[9:].replace("/", "-")
 
 
+class ClanMemberIndex:
+    def __init__(
+        self,
+        registered_caseless_battle_tags: set,
+        unregistered_character_keys_per_region: dict,
+    ):
+        self.registered_caseless_battle_tags = registered_caseless_battle_tags
+        self.unregistered_character_keys_per_region = (
+            unregistered_character_keys_per_region
+        )
+
+    def is_registered(self, caseless_battle_tag: str) -> bool:
+        return (
+            urllib.parse.quote(caseless_battle_tag)
+            in self.registered_caseless_battle_tags
+        )
+
+    def unregistered_character_keys(self, region: str) -> set:
+        return self.unregistered_character_keys_per_region.get(region, set())
+
+
+def build_clan_member_index(members: dict, regions: list = REGIONS) -> ClanMemberIndex:
+    registered_caseless_battle_tags = set(
+        member_data["caseless_battle_tag"]
+        for member_data in members.values()
+        if member_data and member_data.get("caseless_battle_tag")
+    )
+
+    unregistered_character_keys_per_region = {}
+    for region in regions:
+        db_characters = (
+            reference().child("unregistered_members").child(region).get(shallow=True)
+        )
+        metrics.increment("firebase_reads_total", "unregistered_members")
+        unregistered_character_keys_per_region[region] = set(db_characters or {})
+
+    return ClanMemberIndex(
+        registered_caseless_battle_tags, unregistered_character_keys_per_region
+    )
+
+
 def update_unregistered_member_ladder_summary_for_member(
-    region: str, current_season_id: int, mmrs: list, clan_member: dict
+    region: str,
+    current_season_id: int,
+    percentile: float,
+    clan_member: LadderTeam,
+    clan_member_index: ClanMemberIndex,
+    batch: WriteBatch,
+    tier: int = None,
+    shard=None,
 ):
-    if not clan_member.get("member"):
-        return
-
-    member_data = clan_member["member"][0]
-    battle_tag = member_data.get("character_link", {}).get("battle_tag", "")
+    battle_tag = clan_member.battle_tag
     caseless_battle_tag = battle_tag.casefold()
 
-    registered_clan_member = (
-        reference("members")
-        .order_by_child("caseless_battle_tag")
-        .equal_to(urllib.parse.quote(caseless_battle_tag))
-        .get()
-    )
-    if registered_clan_member:
+    if clan_member_index.is_registered(caseless_battle_tag):
         return
 
-    character_key = _gen_character_key(clan_member)
-    if not character_key:
+    character_key = clan_member.character_key
+    if not character_key or (shard is not None and character_key not in shard):
         return
 
-    member_data = clan_member["member"][0]
-    played_race_count_data = next(iter(member_data.get("played_race_count", [])), {})
-    race = str(next(iter(played_race_count_data.get("race", {}).values()), ""))
+    race = clan_member.race
     if not race:
         return
 
-    mmr = clan_member.get("rating", 0)
-    wins = clan_member.get("wins", 0)
-    losses = clan_member.get("losses", 0)
-    ties = clan_member.get("ties", 0)
     ladder_summary = {
-        "current_win_streak": clan_member.get("current_win_streak", 0),
-        "games_played": clan_member.get(wins + losses + ties, 0),
-        "last_played_time_stamp": clan_member.get("last_played_time_stamp", 0),
-        "league_id": clan_member.get("league_id", 0),
-        "longest_win_streak": clan_member.get("longest_win_streak", 0),
-        "losses": losses,
-        "mmr": mmr,
-        "percentile": calculate_percentile(mmr, mmrs),
-        "ties": ties,
-        "wins": wins,
+        "current_win_streak": clan_member.current_win_streak,
+        "games_played": clan_member.wins + clan_member.losses + clan_member.ties,
+        "last_played_time_stamp": clan_member.last_played_time_stamp,
+        "league_id": clan_member.league_id,
+        "longest_win_streak": clan_member.longest_win_streak,
+        "losses": clan_member.losses,
+        "mmr": clan_member.rating,
+        "percentile": percentile,
+        "ties": clan_member.ties,
+        "wins": clan_member.wins,
     }
+    if tier is not None:
+        ladder_summary["tier"] = tier
 
-    character_ref = (
-        reference().child("unregistered_members").child(region).child(character_key)
+    character_path = join_path("unregistered_members", region, character_key)
+    batch.update(
+        character_path,
+        {"battle_tag": battle_tag, "caseless_battle_tag": caseless_battle_tag},
     )
-    character_ref.update(
-        {"battle_tag": battle_tag, "caseless_battle_tag": caseless_battle_tag}
-    )
-    character_ref.child("ladder_info").child(str(current_season_id)).child(race).set(
-        ladder_summary
+    batch.set(
+        join_path(character_path, "ladder_info", current_season_id, race),
+        ladder_summary,
     )
 
 
-def purge_non_member_unregistered_members(region: str, clan_members: list):
-    member_character_keys = set(map(_gen_character_key, clan_members))
-    db_characters = (
-        reference().child("unregistered_members").child(region).get(shallow=True)
-    )
-    db_characters = db_characters if db_characters else {}
-    db_character_keys = list(db_characters.keys())
+def purge_non_member_unregistered_members(
+    region: str,
+    clan_members: list,
+    clan_member_index: ClanMemberIndex,
+    batch: WriteBatch,
+    shard=None,
+):
+    member_character_keys = set(x.character_key for x in clan_members)
+    db_character_keys = clan_member_index.unregistered_character_keys(region)
+    if shard is not None:
+        db_character_keys = set(x for x in db_character_keys if x in shard)
 
-    for db_character_key in db_character_keys:
-        if db_character_key not in member_character_keys:
-            reference().child("unregistered_members").child(region).child(
-                db_character_key
-            ).delete()
+    for db_character_key in db_character_keys - member_character_keys:
+        batch.delete(join_path("unregistered_members", region, db_character_key))
 
 
 def _ignore_failure(func, default):
     # noinspection PyBroadException
     try:
         return func()
-    except Exception:
+    except Exception as e:
+        record_ignored_failure(e)
         return default
+
+
+def record_ignored_failure(error: Exception):
+    metrics.increment("swallowed_failures_total", type(error).__name__)
+    # Unranked and deleted profiles are a 404, which isn't retried and is too
+    # common to log each time.
+    if isinstance(error, ratelimit.RequestError) and error.status == 404:
+        return
+    print("Request failed, continuing without it: " + str(error))
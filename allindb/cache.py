@@ -0,0 +1,75 @@
+import collections
+import concurrent.futures
+import threading
+
+LADDER_CACHE_SIZE = 4096
+
+
+class LadderCache:
+    def __init__(self, max_size: int = LADDER_CACHE_SIZE):
+        self.max_size = max_size
+        self._entries = collections.OrderedDict()
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        region, ladder_id = key
+        with self._lock:
+            return (region, str(ladder_id)) in self._entries
+
+    def peek(self, region: str, ladder_id):
+        key = (region, str(ladder_id))
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+            return self._entries.get(key)
+
+    def put(self, region: str, ladder_id, ladder_data: dict):
+        with self._lock:
+            self._store((region, str(ladder_id)), ladder_data)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def get(self, region: str, ladder_id, fetch):
+        key = (region, str(ladder_id))
+
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+
+            future = self._in_flight.get(key)
+            is_fetching_thread = future is None
+            if is_fetching_thread:
+                future = concurrent.futures.Future()
+                self._in_flight[key] = future
+
+        # Only one thread fetches a given ladder; everyone else waits on it.
+        if not is_fetching_thread:
+            return future.result()
+
+        try:
+            result = fetch()
+        except BaseException as e:
+            with self._lock:
+                del self._in_flight[key]
+            future.set_exception(e)
+            raise
+
+        with self._lock:
+            del self._in_flight[key]
+            self._store(key, result)
+
+        future.set_result(result)
+        return result
+
+    def _store(self, key: tuple, result):
+        self._entries[key] = result
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
@@ -1,44 +1,54 @@
-import time
-
-from firebase_admin.db import reference
 import requests
 
-RETRIES = 5
+from allindb import ratelimit
+from allindb.firebase import WriteBatch, join_path
 
+API_URL = "https://discordapp.com/api"
+GUILD_MEMBERS_PAGE_SIZE = 1000
 
-def get_member_info(bot_token: str, guild_id: str, member_id: str) -> dict:
-    url = "https://discordapp.com/api/guilds/{}/members/{}".format(guild_id, member_id)
+_session = requests.Session()
 
-    tries = 0
-    while tries < RETRIES:
-        try:
-            response = requests.get(url, headers={"Authorization": "Bot " + bot_token})
-            if response.status_code == 200:
-                return response.json()
 
-            if response.status_code == 404:
-                print("Unknown member: " + member_id)
-                return {}
+def get_member_info(bot_token: str, guild_id: str, member_id: str) -> dict:
+    url = "{}/guilds/{}/members/{}".format(API_URL, guild_id, member_id)
 
-            if response.status_code == 429:
-                body = response.json()
-                time.sleep(body.get("retry_after", 1000) * 0.001)
-        except Exception as e:
-            print(e)
-            pass
+    try:
+        response = ratelimit.scheduler.request(
+            _session,
+            "GET",
+            url,
+            route="GET /guilds/{}/members/:id".format(guild_id),
+            passthrough_statuses=(404,),
+            headers={"Authorization": "Bot " + bot_token},
+        )
+    except Exception as e:
+        print(e)
+        print("Failed to fetch member info for: " + member_id + ", skipping")
+        return {}
 
-        print("Failed to fetch member info for: " + member_id + ", retrying")
-        tries += 1
+    if response.status_code == 404:
+        print("Unknown member: " + member_id)
+        return {}
 
-    print("Failed to fetch member info for: " + member_id + ", skipping")
-    return {}
+    return response.json()
 
 
 def update_discord_info_for_member(
-        bot_token: str, guild_id: str, full_member_role_id: str, member_key: str
+        bot_token: str,
+        guild_id: str,
+        full_member_role_id: str,
+        member_key: str,
+        batch: WriteBatch,
 ):
     member_info = get_member_info(bot_token, guild_id, member_key)
+    update_discord_info_from_member_info(
+        full_member_role_id, member_key, member_info, batch
+    )
+
 
+def update_discord_info_from_member_info(
+        full_member_role_id: str, member_key: str, member_info: dict, batch: WriteBatch
+):
     # TODO: Do something about old members who've left the server
     if member_info:
         discord_server_nick = member_info.get("nick", "")
@@ -51,4 +61,61 @@ def update_discord_info_for_member(
         if discord_server_nick:
             data["discord_server_nick"] = discord_server_nick
 
-        reference().child("members").child(member_key).update(data)
+        batch.update(join_path("members", member_key), data)
+
+
+def list_guild_members(
+        bot_token: str,
+        guild_id: str,
+        page_size: int = GUILD_MEMBERS_PAGE_SIZE,
+):
+    url = "{}/guilds/{}/members".format(API_URL, guild_id)
+
+    after = "0"
+    while True:
+        page = ratelimit.scheduler.request(
+            _session,
+            "GET",
+            url,
+            route="GET /guilds/{}/members".format(guild_id),
+            params={"limit": page_size, "after": after},
+            headers={"Authorization": "Bot " + bot_token},
+        ).json()
+
+        yield from page
+
+        if len(page) < page_size:
+            return
+
+        after = page[-1]["user"]["id"]
+
+
+def update_discord_info_for_members_in_bulk(
+        bot_token: str,
+        guild_id: str,
+        full_member_role_id: str,
+        member_keys: list,
+        batch: WriteBatch,
+) -> set:
+    unmatched_member_keys = set(member_keys)
+
+    try:
+        for member_info in list_guild_members(bot_token, guild_id):
+            member_key = member_info.get("user", {}).get("id", "")
+            if member_key in unmatched_member_keys:
+                unmatched_member_keys.remove(member_key)
+                update_discord_info_from_member_info(
+                    full_member_role_id, member_key, member_info, batch
+                )
+    except (ratelimit.RequestError, requests.RequestException) as e:
+        # Listing needs the guild members intent, which fetching members one
+        # at a time doesn't, so the rest are fetched that way instead.
+        print(e)
+        print("Failed to list guild members, fetching remaining members individually")
+        for member_key in unmatched_member_keys:
+            update_discord_info_for_member(
+                bot_token, guild_id, full_member_role_id, member_key, batch
+            )
+        return set()
+
+    return unmatched_member_keys
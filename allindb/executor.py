@@ -1,15 +1,292 @@
+import abc
 import concurrent.futures
+import heapq
+import itertools
+import threading
+import time
 
+from allindb.metrics import metrics
+
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+
+class TaskExecutor(concurrent.futures.Executor, metaclass=abc.ABCMeta):
+    # Priorities and timeouts are options of a submission rather than of the
+    # executor, so stages share one pool through lightweight views of it.
+    def __init__(self, max_pending: int = 0):
+        self._pending_slots = (
+            threading.BoundedSemaphore(max_pending) if max_pending else None
+        )
+        self._deadlines = None
+        self._deadlines_lock = threading.Lock()
+
+    def submit(self, fn, *args, **kwargs):
+        return self.submit_with_options(PRIORITY_NORMAL, None, fn, *args, **kwargs)
+
+    def with_options(
+        self, priority: int = PRIORITY_NORMAL, timeout: float = None
+    ) -> "ExecutorView":
+        return ExecutorView(self, priority, timeout)
+
+    def submit_with_options(
+        self, priority: int, timeout: float, fn, *args, **kwargs
+    ) -> concurrent.futures.Future:
+        # Blocking here is the backpressure: submitters wait for a slot rather
+        # than queueing an unbounded number of futures.
+        if self._pending_slots:
+            self._pending_slots.acquire()
+
+        try:
+            future = self._submit(priority, timeout, fn, args, kwargs)
+        except BaseException:
+            if self._pending_slots:
+                self._pending_slots.release()
+            raise
+
+        if self._pending_slots:
+            future.add_done_callback(lambda _: self._pending_slots.release())
+        return future
+
+    @abc.abstractmethod
+    def _submit(self, priority: int, timeout: float, fn, args: tuple, kwargs: dict):
+        pass
+
+    def _expire_after(self, future: concurrent.futures.Future, timeout: float):
+        # Worker threads start running tasks concurrently, so the deadline
+        # thread is created under a lock.
+        with self._deadlines_lock:
+            if self._deadlines is None:
+                self._deadlines = _Deadlines()
+        self._deadlines.add(future, time.monotonic() + timeout)
+
+    def shutdown(self, wait=True, *, cancel_futures=False):
+        if self._deadlines is not None:
+            self._deadlines.stop()
+
+
+class ExecutorView(concurrent.futures.Executor):
+    def __init__(self, executor: TaskExecutor, priority: int, timeout: float):
+        self.executor = executor
+        self.priority = priority
+        self.timeout = timeout
 
-class CurrentThreadExecutor(concurrent.futures.Executor):
     def submit(self, fn, *args, **kwargs):
-        result = fn(*args, **kwargs)
+        return self.executor.submit_with_options(
+            self.priority, self.timeout, fn, *args, **kwargs
+        )
+
+    def with_options(
+        self, priority: int = PRIORITY_NORMAL, timeout: float = None
+    ) -> "ExecutorView":
+        return self.executor.with_options(priority, timeout)
+
+    def shutdown(self, wait=True, *, cancel_futures=False):
+        return
+
+
+class CurrentThreadExecutor(TaskExecutor):
+    def _submit(self, priority: int, timeout: float, fn, args: tuple, kwargs: dict):
         future = concurrent.futures.Future()
-        future.set_result(result)
+        future.set_running_or_notify_cancel()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
         return future
 
     def map(self, func, *iterables, timeout=None, chunksize=1):
         return list(map(func, *iterables))
 
-    def shutdown(wait=True):
+    def shutdown(self, wait=True, *, cancel_futures=False):
         return
+
+
+class PriorityThreadPoolExecutor(TaskExecutor):
+    def __init__(self, max_workers: int, max_pending: int = 0):
+        super().__init__(max_pending)
+        self._max_workers = max_workers
+        self._queue = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._threads = []
+        self._shutdown = False
+
+    def _submit(self, priority: int, timeout: float, fn, args: tuple, kwargs: dict):
+        future = concurrent.futures.Future()
+        with self._condition:
+            if self._shutdown:
+                raise RuntimeError("cannot schedule new futures after shutdown")
+
+            # Equal priorities run in submission order, so a task may wait on
+            # any future submitted before it at the same or higher priority.
+            heapq.heappush(
+                self._queue,
+                (priority, next(self._sequence), future, timeout, fn, args, kwargs),
+            )
+            if len(self._threads) < self._max_workers:
+                thread = threading.Thread(target=self._work, daemon=True)
+                self._threads.append(thread)
+                thread.start()
+            self._condition.notify()
+        return future
+
+    def _work(self):
+        while True:
+            with self._condition:
+                while not self._queue and not self._shutdown:
+                    self._condition.wait()
+                if not self._queue:
+                    return
+                _, _, future, timeout, fn, args, kwargs = heapq.heappop(self._queue)
+
+            if not future.set_running_or_notify_cancel():
+                continue
+            # Timeouts count from when a task starts running, not from when it
+            # was submitted, so time queued behind other tasks doesn't use them.
+            if timeout:
+                self._expire_after(future, timeout)
+
+            try:
+                result = fn(*args, **kwargs)
+            except BaseException as e:
+                _settle(future.set_exception, e)
+            else:
+                _settle(future.set_result, result)
+
+    def shutdown(self, wait=True, *, cancel_futures=False):
+        with self._condition:
+            self._shutdown = True
+            if cancel_futures:
+                for _, _, future, _, _, _, _ in self._queue:
+                    future.cancel()
+                self._queue = []
+            self._condition.notify_all()
+
+        if wait:
+            for thread in self._threads:
+                thread.join()
+        super().shutdown(wait, cancel_futures=cancel_futures)
+
+
+class PoolExecutor(TaskExecutor):
+    # Bounded submission over a standard pool, chiefly a process pool for CPU
+    # bound work. Pools run tasks in submission order, so priorities are
+    # accepted but have no effect, and they don't say when a task starts, so
+    # timeouts count from submission.
+    def __init__(self, executor: concurrent.futures.Executor, max_pending: int = 0):
+        super().__init__(max_pending)
+        self._executor = executor
+
+    def _submit(self, priority: int, timeout: float, fn, args: tuple, kwargs: dict):
+        pool_future = self._executor.submit(fn, *args, **kwargs)
+        if not timeout:
+            return pool_future
+
+        # The pool settles its own futures, so the timeout settles a copy.
+        future = concurrent.futures.Future()
+        future.set_running_or_notify_cancel()
+        pool_future.add_done_callback(lambda x: _copy_outcome(x, future))
+        self._expire_after(future, timeout)
+        return future
+
+    def shutdown(self, wait=True, *, cancel_futures=False):
+        self._executor.shutdown(wait, cancel_futures=cancel_futures)
+        super().shutdown(wait, cancel_futures=cancel_futures)
+
+
+def create_executor(
+    mode: str, max_workers: int, max_pending: int = 0
+) -> TaskExecutor:
+    if mode == "thread":
+        return PriorityThreadPoolExecutor(max_workers, max_pending)
+    if mode == "current_thread":
+        return CurrentThreadExecutor()
+    if mode == "process":
+        # Tasks and their results are pickled, so only module level functions
+        # over plain data can run here.
+        return PoolExecutor(
+            concurrent.futures.ProcessPoolExecutor(max_workers), max_pending
+        )
+    raise ValueError("Unknown executor mode: " + mode)
+
+
+class InstrumentedExecutor(concurrent.futures.Executor):
+    def __init__(self, executor: TaskExecutor, name: str = "executor"):
+        self._executor = executor
+        self._gauge = name + "_pending_tasks"
+
+    def submit(self, fn, *args, **kwargs):
+        return self._instrument(self._executor.submit, fn, *args, **kwargs)
+
+    def with_options(
+        self, priority: int = PRIORITY_NORMAL, timeout: float = None
+    ) -> "InstrumentedExecutor":
+        view = InstrumentedExecutor(self._executor.with_options(priority, timeout))
+        view._gauge = self._gauge
+        return view
+
+    def _instrument(self, submit, fn, *args, **kwargs):
+        metrics.add_to_gauge(self._gauge, 1)
+        future = submit(fn, *args, **kwargs)
+        future.add_done_callback(lambda _: metrics.add_to_gauge(self._gauge, -1))
+        return future
+
+    def shutdown(self, wait=True, *, cancel_futures=False):
+        self._executor.shutdown(wait, cancel_futures=cancel_futures)
+
+
+class _Deadlines:
+    def __init__(self):
+        self._deadlines = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._stopped = False
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def add(self, future: concurrent.futures.Future, deadline: float):
+        with self._condition:
+            heapq.heappush(self._deadlines, (deadline, next(self._sequence), future))
+            self._condition.notify()
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+
+    def _run(self):
+        with self._condition:
+            while not self._stopped:
+                now = time.monotonic()
+                while self._deadlines and self._deadlines[0][0] <= now:
+                    _, _, future = heapq.heappop(self._deadlines)
+                    # A queued task is cancelled outright; a running one can't
+                    # be interrupted, so its result is abandoned instead.
+                    if not future.cancel():
+                        _settle(
+                            future.set_exception,
+                            concurrent.futures.TimeoutError("Task timed out"),
+                        )
+
+                timeout = self._deadlines[0][0] - now if self._deadlines else None
+                self._condition.wait(timeout)
+
+
+def _copy_outcome(
+    source: concurrent.futures.Future, target: concurrent.futures.Future
+):
+    if source.cancelled():
+        _settle(target.set_exception, concurrent.futures.CancelledError())
+    elif source.exception() is not None:
+        _settle(target.set_exception, source.exception())
+    else:
+        _settle(target.set_result, source.result())
+
+
+def _settle(set_outcome, outcome):
+    try:
+        set_outcome(outcome)
+    except concurrent.futures.InvalidStateError:
+        # Already settled by a timeout.
+        pass
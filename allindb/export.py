@@ -0,0 +1,186 @@
+import glob
+import gzip
+import json
+import os
+import threading
+import zlib
+
+from allindb import firebase
+from allindb.metrics import metrics
+
+EXPORT_PATH = "update_db.export.jsonl.gz"
+BASELINE_PATH = "update_db.baseline.json.gz"
+UPLOAD_BATCH_SIZE = 10000
+
+_MISSING = object()
+
+
+class ExportSink:
+    # Appends each committed batch as a JSON line instead of sending it, so
+    # the output of runs that were killed, or that ran before the last upload,
+    # is kept for the next one. The file is reopened for every batch, so once
+    # an upload moves it aside the next batch starts a new one.
+    def __init__(self, path: str = EXPORT_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def update(self, updates: dict):
+        line = json.dumps(updates) + "\n"
+        with self._lock:
+            metrics.increment("export_writes_total")
+            metrics.increment("export_write_paths_total", value=len(updates))
+            with gzip.open(self.path, "at") as export_file:
+                export_file.write(line)
+
+
+class _Write:
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+
+def read_updates(path: str):
+    try:
+        with gzip.open(path, "rt") as export_file:
+            for line in export_file:
+                yield json.loads(line)
+    except (EOFError, zlib.error, ValueError):
+        # The tail of a killed run's export; everything before it is intact.
+        print("Ignoring truncated end of " + path)
+
+
+def coalesce(updates) -> dict:
+    # Replays multi-path updates in order into one set of non-overlapping
+    # paths, with the same ancestor and descendant rules as WriteBatch but in
+    # time proportional to path depth rather than to the number of paths.
+    root = {}
+    for batch in updates:
+        for path, value in batch.items():
+            segments = firebase.join_path(path).split("/")
+            node = root
+            for depth, segment in enumerate(segments[:-1]):
+                child = node.get(segment)
+                if isinstance(child, _Write):
+                    child.value = firebase.merge_into(
+                        child.value, segments[depth + 1 :], value
+                    )
+                    break
+                if child is None:
+                    child = node[segment] = {}
+                node = child
+            else:
+                node[segments[-1]] = _Write(value)
+
+    paths = {}
+    stack = [("", root)]
+    while stack:
+        prefix, node = stack.pop()
+        for segment, child in node.items():
+            path = prefix + segment
+            if isinstance(child, _Write):
+                paths[path] = child.value
+            else:
+                stack.append((path + "/", child))
+    return paths
+
+
+def _lookup(tree: dict, path: str):
+    node = tree
+    for segment in path.split("/"):
+        if not isinstance(node, dict) or segment not in node:
+            return _MISSING
+        node = node[segment]
+    return node
+
+
+def diff(paths: dict, baseline: dict) -> dict:
+    # Paths the baseline doesn't know about are always sent, since they may
+    # hold data written by someone else.
+    changed = {}
+    for path, value in paths.items():
+        uploaded_value = _lookup(baseline, path)
+        if uploaded_value is _MISSING or uploaded_value != value:
+            changed[path] = value
+    return changed
+
+
+def apply(paths: dict, baseline: dict):
+    for path, value in paths.items():
+        segments = path.split("/")
+        node = baseline
+        for segment in segments[:-1]:
+            if not isinstance(node.get(segment), dict):
+                node[segment] = {}
+            node = node[segment]
+        if value is None:
+            node.pop(segments[-1], None)
+        else:
+            node[segments[-1]] = value
+
+
+def load_baseline(path: str) -> dict:
+    try:
+        with gzip.open(path, "rt") as baseline_file:
+            return json.load(baseline_file)
+    except (OSError, EOFError, ValueError):
+        return {}
+
+
+def save_baseline(path: str, baseline: dict):
+    temp_path = path + ".tmp"
+    with gzip.open(temp_path, "wt") as baseline_file:
+        json.dump(baseline, baseline_file)
+    os.replace(temp_path, path)
+
+
+def _upload_file(path: str, baseline_path: str, batch_size: int) -> int:
+    paths = coalesce(read_updates(path))
+    baseline = load_baseline(baseline_path)
+    changed = diff(paths, baseline)
+    print(
+        "{} of {} exported paths changed since the last upload.".format(
+            len(changed), len(paths)
+        )
+    )
+    chunk = {}
+    for changed_path, value in changed.items():
+        chunk[changed_path] = value
+        if len(chunk) >= batch_size:
+            firebase.sink.update(chunk)
+            chunk = {}
+    if chunk:
+        firebase.sink.update(chunk)
+
+    apply(paths, baseline)
+    save_baseline(baseline_path, baseline)
+    os.remove(path)
+    return len(changed)
+
+
+def _export_paths(export_path: str) -> list:
+    # Sharded runs export a file each, named after the unsharded one.
+    shard_paths = set(
+        path[: -len(".uploading")] if path.endswith(".uploading") else path
+        for path in glob.glob(glob.escape(export_path) + ".shard-*")
+    )
+    return [export_path] + sorted(shard_paths)
+
+
+def upload(
+    export_path: str = EXPORT_PATH,
+    baseline_path: str = BASELINE_PATH,
+    batch_size: int = UPLOAD_BATCH_SIZE,
+) -> int:
+    # Each export is moved aside before reading, so a run exporting meanwhile
+    # starts a new file. One left behind by an interrupted upload goes first;
+    # resending it is harmless.
+    uploaded = 0
+    for path in _export_paths(export_path):
+        uploading_path = path + ".uploading"
+        if os.path.exists(uploading_path):
+            uploaded += _upload_file(uploading_path, baseline_path, batch_size)
+        if os.path.exists(path):
+            os.replace(path, uploading_path)
+            uploaded += _upload_file(uploading_path, baseline_path, batch_size)
+    return uploaded
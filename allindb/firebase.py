@@ -0,0 +1,139 @@
+import copy
+import threading
+
+from firebase_admin.db import reference
+
+from allindb.metrics import metrics
+
+MAX_BATCH_SIZE = 500
+SNAPSHOT_PAGE_SIZE = 1000
+
+
+def join_path(*segments) -> str:
+    return "/".join(
+        str(segment).strip("/") for segment in segments if str(segment).strip("/")
+    )
+
+
+def merge_into(value, relative_segments: list, new_value):
+    root = dict(value) if isinstance(value, dict) else {}
+    node = root
+    for segment in relative_segments[:-1]:
+        child = node.get(segment)
+        node[segment] = dict(child) if isinstance(child, dict) else {}
+        node = node[segment]
+    node[relative_segments[-1]] = new_value
+    return root
+
+
+class FirebaseSink:
+    def update(self, updates: dict):
+        metrics.increment("firebase_writes_total")
+        metrics.increment("firebase_write_paths_total", value=len(updates))
+        reference().update(updates)
+
+
+# Where committed batches go; replaced to export writes instead of sending them.
+sink = FirebaseSink()
+
+
+def get_member(member_key: str) -> dict:
+    metrics.increment("firebase_reads_total", "member")
+    return reference().child("members").child(member_key).get() or {}
+
+
+def get_members_snapshot(page_size: int = SNAPSHOT_PAGE_SIZE) -> dict:
+    if not page_size:
+        metrics.increment("firebase_reads_total", "members")
+        return reference().child("members").get() or {}
+
+    members = {}
+    last_key = None
+    while True:
+        query = reference().child("members").order_by_key()
+        if last_key is None:
+            page = query.limit_to_first(page_size).get() or {}
+        else:
+            # start_at is inclusive, so fetch one extra and drop the last key
+            page = query.start_at(last_key).limit_to_first(page_size + 1).get() or {}
+            page.pop(last_key, None)
+        metrics.increment("firebase_reads_total", "members")
+
+        if not page:
+            break
+
+        members.update(page)
+        last_key = list(page.keys())[-1]
+
+        if len(page) < page_size:
+            break
+
+    return members
+
+
+class WriteBatch:
+    def __init__(self, max_size: int = MAX_BATCH_SIZE):
+        self._max_size = max_size
+        self._updates = {}
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._updates)
+
+    def set(self, path: str, value):
+        with self._lock:
+            self._put(path, value)
+            if self._max_size and len(self._updates) >= self._max_size:
+                self.commit()
+
+    def update(self, path: str, data: dict):
+        with self._lock:
+            for key, value in data.items():
+                self._put(join_path(path, key), value)
+            if self._max_size and len(self._updates) >= self._max_size:
+                self.commit()
+
+    def delete(self, path: str):
+        self.set(path, None)
+
+    def apply_to(self, tree: dict):
+        with self._lock:
+            for path, value in self._updates.items():
+                segments = path.split("/")
+                node = tree
+                for segment in segments[:-1]:
+                    if not isinstance(node.get(segment), dict):
+                        node[segment] = {}
+                    node = node[segment]
+                if value is None:
+                    node.pop(segments[-1], None)
+                else:
+                    node[segments[-1]] = copy.deepcopy(value)
+
+    def commit(self):
+        with self._lock:
+            updates, self._updates = self._updates, {}
+            if updates:
+                sink.update(updates)
+
+    # Firebase rejects multi-path updates where one path is an ancestor of
+    # another, so writes below a pending path are merged into its value and
+    # writes above a pending path replace it. A delete followed by a re-set
+    # of the same subtree therefore lands in one atomic update.
+    def _put(self, path: str, value):
+        path = join_path(path)
+        segments = path.split("/")
+
+        for depth in range(1, len(segments)):
+            ancestor = "/".join(segments[:depth])
+            if ancestor in self._updates:
+                self._updates[ancestor] = merge_into(
+                    self._updates[ancestor], segments[depth:], value
+                )
+                return
+
+        prefix = path + "/"
+        for descendant in [x for x in self._updates if x.startswith(prefix)]:
+            del self._updates[descendant]
+
+        self._updates[path] = value
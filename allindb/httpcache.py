@@ -0,0 +1,86 @@
+import collections
+import sqlite3
+import threading
+
+# Seconds a cached response is served without revalidation, per route. League
+# responses are revalidated on every run, since divisions open mid season and
+# an unchanged league still costs only a 304. Ladders and profiles change
+# constantly and are large, so they aren't stored; runs an hour or more apart
+# would never reuse them.
+TTL_PER_ROUTE = {
+    "season": 60 * 60,
+    "league": 0,
+}
+# Expired responses are kept this long for revalidation before being purged.
+PURGE_GRACE = 7 * 24 * 60 * 60
+
+CachedResponse = collections.namedtuple(
+    "CachedResponse", ["body", "etag", "last_modified", "expires_at"]
+)
+
+
+class HttpCache:
+    def __init__(self, path: str, ttl_per_route: dict = None):
+        self.path = path
+        self.ttl_per_route = dict(
+            TTL_PER_ROUTE if ttl_per_route is None else ttl_per_route
+        )
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(
+            path, check_same_thread=False, isolation_level=None
+        )
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, "
+            "body TEXT NOT NULL, "
+            "etag TEXT, "
+            "last_modified TEXT, "
+            "expires_at REAL NOT NULL)"
+        )
+
+    def ttl(self, route: str):
+        return self.ttl_per_route.get(route)
+
+    def get(self, key: str) -> CachedResponse:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT body, etag, last_modified, expires_at "
+                "FROM responses WHERE key = ?",
+                (key,),
+            ).fetchone()
+        return CachedResponse(*row) if row else None
+
+    def put(
+        self,
+        key: str,
+        body: str,
+        expires_at: float,
+        etag: str = None,
+        last_modified: str = None,
+    ):
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO responses "
+                "(key, body, etag, last_modified, expires_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (key, body, etag, last_modified, expires_at),
+            )
+
+    def touch(self, key: str, expires_at: float):
+        with self._lock:
+            self._connection.execute(
+                "UPDATE responses SET expires_at = ? WHERE key = ?",
+                (expires_at, key),
+            )
+
+    def purge_expired(self, now: float, grace: float = PURGE_GRACE):
+        with self._lock:
+            self._connection.execute(
+                "DELETE FROM responses WHERE expires_at < ?", (now - grace,)
+            )
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
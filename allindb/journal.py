@@ -0,0 +1,115 @@
+import json
+import os
+import threading
+import time
+
+JOURNAL_MAX_AGE = 60 * 60
+
+
+class Journal:
+    # An append-only record of a run's progress, one JSON object per line.
+    # Until it is opened, and once it is finished, every method is a no-op,
+    # so code paths that don't checkpoint can share it.
+    def __init__(self, path: str = "", max_age: float = JOURNAL_MAX_AGE):
+        self.path = path
+        self.sweep_path = path + ".sweep.json.gz"
+        self.max_age = max_age
+        self._file = None
+        self._stages = {}
+        self._member_keys = set()
+        self._lock = threading.Lock()
+
+    def open(self, current_season_id_per_region: dict) -> bool:
+        if not self.path:
+            return False
+
+        entries, valid_size = self._read()
+        header = entries[0] if entries else {}
+        resumed = (
+            header.get("season_ids") == current_season_id_per_region
+            and time.time() - header.get("started_at", 0) < self.max_age
+        )
+
+        if resumed:
+            for entry in entries[1:]:
+                if "stage" in entry:
+                    self._stages[entry["stage"]] = entry
+                elif "member" in entry:
+                    self._member_keys.add(entry["member"])
+
+            # Drop a line torn by the crash before appending after it.
+            self._file = open(self.path, "r+")
+            self._file.truncate(valid_size)
+            self._file.seek(valid_size)
+            print(
+                "Resuming from journal with {} stages and {} members done.".format(
+                    len(self._stages), len(self._member_keys)
+                )
+            )
+        else:
+            self._file = open(self.path, "w")
+            self._append(
+                {
+                    "season_ids": current_season_id_per_region,
+                    "started_at": time.time(),
+                }
+            )
+        return resumed
+
+    @property
+    def is_open(self) -> bool:
+        return self._file is not None
+
+    def stage(self, name: str) -> dict:
+        return self._stages.get(name)
+
+    def record_stage(self, name: str, **data):
+        entry = dict(data, stage=name)
+        if self._append(entry):
+            self._stages[name] = entry
+
+    def is_processed(self, member_key: str) -> bool:
+        return member_key in self._member_keys
+
+    def record_member(self, member_key: str):
+        if self._append({"member": member_key}):
+            self._member_keys.add(member_key)
+
+    def finish(self):
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.close()
+            self._file = None
+
+        for path in (self.path, self.sweep_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _append(self, entry: dict) -> bool:
+        with self._lock:
+            if self._file is None:
+                return False
+            # Flushed per entry, so a killed run loses at most the entry it
+            # was writing.
+            self._file.write(json.dumps(entry) + "\n")
+            self._file.flush()
+            return True
+
+    def _read(self) -> (list, int):
+        entries = []
+        valid_size = 0
+        try:
+            with open(self.path, "rb") as journal_file:
+                for line in journal_file:
+                    try:
+                        entries.append(json.loads(line))
+                    except ValueError:
+                        break
+                    if not line.endswith(b"\n"):
+                        entries.pop()
+                        break
+                    valid_size += len(line)
+        except OSError:
+            pass
+        return entries, valid_size
@@ -0,0 +1,205 @@
+import bisect
+import collections
+import contextlib
+import json
+import os
+import threading
+import time
+
+LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# Counters whose label packs several values, separated by spaces, exported as
+# a Prometheus label each. Only the first value may itself contain a space.
+LABEL_NAMES = {
+    "http_requests_total": ("route", "status"),
+}
+
+
+class Histogram:
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def merge(self, histogram: dict):
+        # Reports are written with sorted keys, so buckets are matched by name.
+        bucket_names = [str(x) for x in self.buckets] + ["+Inf"]
+        for bucket, count in histogram["buckets"].items():
+            self.counts[bucket_names.index(bucket)] += count
+        self.count += histogram["count"]
+        self.sum += histogram["sum"]
+
+    def to_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "buckets": dict(
+                zip([str(x) for x in self.buckets] + ["+Inf"], self.counts)
+            ),
+        }
+
+
+class Metrics:
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._stage_seconds = collections.OrderedDict()
+        self._counters = collections.defaultdict(collections.Counter)
+        self._histograms = collections.defaultdict(dict)
+        self._gauges = collections.Counter()
+        self._peaks = collections.Counter()
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        if not self.enabled:
+            yield
+            return
+
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add_stage_seconds(name, time.monotonic() - start)
+
+    def add_stage_seconds(self, name: str, seconds: float):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._stage_seconds[name] = self._stage_seconds.get(name, 0.0) + seconds
+
+    def increment(self, name: str, label: str = "", value: int = 1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._counters[name][label] += value
+
+    def observe(self, name: str, label: str, value: float):
+        if not self.enabled:
+            return
+        with self._lock:
+            histogram = self._histograms[name].get(label)
+            if histogram is None:
+                histogram = self._histograms[name][label] = Histogram()
+            histogram.observe(value)
+
+    def add_to_gauge(self, name: str, value: int):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._gauges[name] += value
+            self._peaks[name] = max(self._peaks[name], self._gauges[name])
+
+    def report(self) -> dict:
+        with self._lock:
+            return {
+                "stage_seconds": dict(self._stage_seconds),
+                "counters": dict(
+                    (name, dict(counter)) for name, counter in self._counters.items()
+                ),
+                "histograms": dict(
+                    (
+                        name,
+                        dict(
+                            (label, histogram.to_dict())
+                            for label, histogram in histograms.items()
+                        ),
+                    )
+                    for name, histograms in self._histograms.items()
+                ),
+                "peaks": dict(self._peaks),
+            }
+
+    def merge(self, report: dict):
+        # Merges a report from a process that ran alongside this one, such as
+        # another shard: counts add up, while stage times and peaks are taken
+        # as the longest and highest seen.
+        with self._lock:
+            for name, seconds in report.get("stage_seconds", {}).items():
+                self._stage_seconds[name] = max(
+                    self._stage_seconds.get(name, 0.0), seconds
+                )
+            for name, counter in report.get("counters", {}).items():
+                self._counters[name].update(counter)
+            for name, histograms in report.get("histograms", {}).items():
+                for label, histogram in histograms.items():
+                    if label not in self._histograms[name]:
+                        self._histograms[name][label] = Histogram()
+                    self._histograms[name][label].merge(histogram)
+            for name, peak in report.get("peaks", {}).items():
+                self._peaks[name] = max(self._peaks[name], peak)
+
+    def write_json(self, path: str):
+        with open(path, "w") as report_file:
+            json.dump(self.report(), report_file, indent=2, sort_keys=True)
+
+    def write_prometheus(self, path: str, prefix: str = "allindb_"):
+        report = self.report()
+        lines = []
+
+        lines.append("# TYPE {}stage_seconds gauge".format(prefix))
+        for name, seconds in report["stage_seconds"].items():
+            lines.append(
+                '{}stage_seconds{{stage="{}"}} {}'.format(prefix, name, seconds)
+            )
+
+        for name, counter in report["counters"].items():
+            lines.append("# TYPE {}{} counter".format(prefix, name))
+            for label, value in counter.items():
+                if label:
+                    lines.append(
+                        "{}{}{{{}}} {}".format(
+                            prefix, name, _prometheus_labels(name, label), value
+                        )
+                    )
+                else:
+                    lines.append("{}{} {}".format(prefix, name, value))
+
+        for name, histograms in report["histograms"].items():
+            lines.append("# TYPE {}{} histogram".format(prefix, name))
+            for label, histogram in histograms.items():
+                cumulative = 0
+                for bucket, count in histogram["buckets"].items():
+                    cumulative += count
+                    lines.append(
+                        '{}{}_bucket{{label="{}",le="{}"}} {}'.format(
+                            prefix, name, label, bucket, cumulative
+                        )
+                    )
+                lines.append(
+                    '{}{}_sum{{label="{}"}} {}'.format(
+                        prefix, name, label, histogram["sum"]
+                    )
+                )
+                lines.append(
+                    '{}{}_count{{label="{}"}} {}'.format(
+                        prefix, name, label, histogram["count"]
+                    )
+                )
+
+        for name, peak in report["peaks"].items():
+            lines.append("# TYPE {}{}_peak gauge".format(prefix, name))
+            lines.append("{}{}_peak {}".format(prefix, name, peak))
+
+        # Write then rename so the node exporter never reads a partial file.
+        with open(path + ".tmp", "w") as metrics_file:
+            metrics_file.write("\n".join(lines) + "\n")
+        os.replace(path + ".tmp", path)
+
+
+def _prometheus_labels(name: str, label: str) -> str:
+    label_names = LABEL_NAMES.get(name, ("label",))
+    label_values = label.rsplit(" ", len(label_names) - 1)
+    if len(label_values) != len(label_names):
+        return 'label="{}"'.format(label)
+    return ",".join(
+        '{}="{}"'.format(label_name, label_value)
+        for label_name, label_value in zip(label_names, label_values)
+    )
+
+
+metrics = Metrics()
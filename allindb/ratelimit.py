@@ -0,0 +1,228 @@
+import random
+import threading
+import time
+import urllib.parse
+
+import requests
+
+from allindb.metrics import metrics
+
+RETRIES = 5
+BASE_BACKOFF = 0.5
+MAX_BACKOFF = 30.0
+MAX_CONCURRENCY = 32
+
+# (requests per second, burst) buckets for each host suffix, all of which a
+# request must pass. Battle.net allows 100 requests per second and 36,000 per
+# hour per client across all regions; the hourly bucket's burst plus an
+# hour's refill stays within that, since a new process starts it full.
+# Discord allows 50 per second globally, on top of the per-route buckets it
+# reports in headers.
+RATE_LIMITS = {
+    "api.blizzard.com": ((100.0, 100), (9.0, 3600)),
+    "battle.net": ((10.0, 10),),
+    "discordapp.com": ((50.0, 50),),
+    "discord.com": ((50.0, 50),),
+}
+DEFAULT_RATE_LIMIT = ((50.0, 50),)
+
+
+class RequestError(Exception):
+    def __init__(self, url: str, status: int):
+        super().__init__("HTTP {} for {}".format(status, url))
+        self.url = url
+        self.status = status
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+
+    def reserve(self, now: float) -> float:
+        self._tokens = min(
+            self.capacity, self._tokens + (now - self._updated) * self.rate
+        )
+        self._updated = now
+        self._tokens -= 1
+        delay = -self._tokens / self.rate if self._tokens < 0 else 0.0
+        return max(delay, self._paused_until - now)
+
+    def pause_until(self, until: float):
+        self._paused_until = max(self._paused_until, until)
+
+
+class AimdLimiter:
+    def __init__(self, maximum: int = MAX_CONCURRENCY, minimum: int = 1):
+        self.maximum = maximum
+        self.minimum = minimum
+        self.limit = float(maximum)
+        self._in_flight = 0
+        self._last_decrease = 0.0
+        self._condition = threading.Condition()
+
+    def __enter__(self):
+        with self._condition:
+            while self._in_flight >= int(self.limit):
+                self._condition.wait()
+            self._in_flight += 1
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        with self._condition:
+            self._in_flight -= 1
+            self._condition.notify()
+
+    def increase(self):
+        with self._condition:
+            self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+            self._condition.notify_all()
+
+    def decrease(self):
+        # Many requests in flight see the same throttling window, so only
+        # halve once per second rather than once per throttled response.
+        with self._condition:
+            now = time.monotonic()
+            if now - self._last_decrease >= 1.0:
+                self.limit = max(self.minimum, self.limit / 2)
+                self._last_decrease = now
+
+
+class RequestScheduler:
+    def __init__(
+        self,
+        max_concurrency: int = MAX_CONCURRENCY,
+        rate_limits: dict = None,
+        retries: int = RETRIES,
+    ):
+        self.rate_limits = dict(RATE_LIMITS if rate_limits is None else rate_limits)
+        self.retries = retries
+        self.concurrency = AimdLimiter(max_concurrency)
+        self._host_buckets = {}
+        self._route_buckets = {}
+        self._lock = threading.Lock()
+
+    def set_max_concurrency(self, max_concurrency: int):
+        self.concurrency.maximum = max_concurrency
+        self.concurrency.limit = min(self.concurrency.limit, max_concurrency)
+
+    def _host_buckets_for(self, host: str) -> list:
+        key = next(
+            (suffix for suffix in self.rate_limits if host.endswith(suffix)), host
+        )
+        if key not in self._host_buckets:
+            self._host_buckets[key] = [
+                TokenBucket(rate, capacity)
+                for rate, capacity in self.rate_limits.get(key, DEFAULT_RATE_LIMIT)
+            ]
+        return self._host_buckets[key]
+
+    def reserve(self, host: str, route: str) -> float:
+        with self._lock:
+            now = time.monotonic()
+            delay = max(bucket.reserve(now) for bucket in self._host_buckets_for(host))
+            route_bucket = self._route_buckets.get((host, route))
+            if route_bucket:
+                delay = max(delay, route_bucket.reserve(now))
+            return delay
+
+    def observe(self, host: str, route: str, status: int, headers) -> float:
+        retry_after = _parse_float(headers.get("Retry-After"))
+        remaining = _parse_float(headers.get("X-RateLimit-Remaining"))
+        reset_after = _parse_float(headers.get("X-RateLimit-Reset-After"))
+        limit = _parse_float(headers.get("X-RateLimit-Limit"))
+
+        with self._lock:
+            now = time.monotonic()
+
+            if limit and reset_after:
+                route_bucket = self._route_buckets.get((host, route))
+                if route_bucket is None:
+                    route_bucket = TokenBucket(limit / reset_after, int(limit))
+                    self._route_buckets[(host, route)] = route_bucket
+                if remaining == 0:
+                    route_bucket.pause_until(now + reset_after)
+
+            if status == 429 and retry_after is not None:
+                if headers.get("X-RateLimit-Global") or (host, route) not in (
+                    self._route_buckets
+                ):
+                    for bucket in self._host_buckets_for(host):
+                        bucket.pause_until(now + retry_after)
+                else:
+                    self._route_buckets[(host, route)].pause_until(now + retry_after)
+
+        if status == 429:
+            self.concurrency.decrease()
+        elif status < 400:
+            self.concurrency.increase()
+
+        return retry_after
+
+    def backoff(self, attempt: int, retry_after: float = None) -> float:
+        jitter = random.uniform(0, min(MAX_BACKOFF, BASE_BACKOFF * 2 ** attempt))
+        return (retry_after or 0.0) + jitter
+
+    def request(
+        self,
+        session: requests.Session,
+        method: str,
+        url: str,
+        route: str = None,
+        passthrough_statuses: tuple = (),
+        **kwargs
+    ) -> requests.Response:
+        host = urllib.parse.urlsplit(url).netloc
+        route = route or host
+
+        attempt = 0
+        while True:
+            time.sleep(self.reserve(host, route))
+
+            error = None
+            retry_after = None
+            with self.concurrency:
+                start = time.monotonic()
+                try:
+                    response = session.request(method, url, **kwargs)
+                except requests.RequestException as e:
+                    response = None
+                    error = e
+                metrics.observe("http_request_seconds", route, time.monotonic() - start)
+
+            metrics.increment(
+                "http_requests_total",
+                "{} {}".format(
+                    route, response.status_code if response is not None else "error"
+                ),
+            )
+
+            if response is not None:
+                retry_after = self.observe(
+                    host, route, response.status_code, response.headers
+                )
+                status = response.status_code
+                if status < 400 or status in passthrough_statuses:
+                    return response
+                if status != 429 and status < 500:
+                    raise RequestError(url, status)
+                error = RequestError(url, status)
+
+            attempt += 1
+            if attempt >= self.retries:
+                raise error
+
+            metrics.increment("http_retries_total", route)
+            time.sleep(self.backoff(attempt, retry_after))
+
+
+def _parse_float(value):
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+scheduler = RequestScheduler()
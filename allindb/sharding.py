@@ -0,0 +1,24 @@
+import zlib
+
+
+class Shard:
+    def __init__(self, index: int = 0, count: int = 1):
+        if count < 1 or not 0 <= index < count:
+            raise ValueError("Invalid shard {}/{}".format(index, count))
+        self.index = index
+        self.count = count
+
+    @classmethod
+    def parse(cls, shard: str) -> "Shard":
+        if not shard:
+            return cls()
+        index, _, count = shard.partition("/")
+        return cls(int(index), int(count))
+
+    def __contains__(self, key: str) -> bool:
+        # crc32 rather than hash(), which is salted per interpreter, so every
+        # process and host assigns a key to the same shard.
+        return self.count == 1 or zlib.crc32(key.encode()) % self.count == self.index
+
+    def __str__(self):
+        return "{}/{}".format(self.index, self.count)
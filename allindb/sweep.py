@@ -0,0 +1,70 @@
+import gzip
+import json
+import os
+
+from allindb import blizzard
+
+
+def save(
+    path: str,
+    current_season_id_per_region: dict,
+    mmrs_per_region: dict,
+    clan_members_per_region: dict,
+    player_index: blizzard.PlayerIndex,
+    members: dict = None,
+):
+    sweep = {
+        "current_season_ids": current_season_id_per_region,
+        "regions": dict(
+            (
+                region,
+                {
+                    "mmrs": mmrs.to_list(),
+                    "tier_boundaries": list(mmrs.tier_boundaries.to_dict().values()),
+                    "clan_members": clan_members_per_region.get(region, []),
+                },
+            )
+            for region, mmrs in mmrs_per_region.items()
+        ),
+        "teams": list(player_index.teams()),
+    }
+    if members is not None:
+        sweep["members"] = members
+
+    # Shards may be waiting on the file, so it only appears once complete. It
+    # is read back once, so fast compression beats a smaller file, and dumps
+    # uses the C encoder where dump encodes piece by piece in Python.
+    temp_path = path + ".tmp"
+    with gzip.open(temp_path, "wt", compresslevel=1) as sweep_file:
+        sweep_file.write(json.dumps(sweep))
+    os.replace(temp_path, path)
+
+
+def load(path: str) -> (dict, dict, dict, blizzard.PlayerIndex, dict):
+    with gzip.open(path, "rt") as sweep_file:
+        sweep = json.load(sweep_file)
+
+    mmrs_per_region = {}
+    clan_members_per_region = {}
+    for region, region_sweep in sweep["regions"].items():
+        mmrs_per_region[region] = blizzard.MmrDistribution(
+            region_sweep["mmrs"],
+            blizzard.TierBoundaries(region_sweep["tier_boundaries"]),
+        )
+        mmrs_per_region[region].finalize()
+        clan_members_per_region[region] = [
+            blizzard.LadderTeam(*clan_member)
+            for clan_member in region_sweep["clan_members"]
+        ]
+
+    player_index = blizzard.PlayerIndex()
+    for region, team, ladder_id in sweep["teams"]:
+        player_index.add_teams(region, [blizzard.LadderTeam(*team)], ladder_id)
+
+    return (
+        sweep["current_season_ids"],
+        mmrs_per_region,
+        clan_members_per_region,
+        player_index,
+        sweep.get("members"),
+    )
@@ -0,0 +1,163 @@
+import collections.abc
+import concurrent.futures
+import json
+import os
+import threading
+import time
+
+from allindb import blizzard
+
+TOKEN_CACHE_PATH = "token_cache.json"
+SEASON_TTL = 60 * 60
+
+
+class AccessTokens(collections.abc.Mapping):
+    # Looks like the plain region -> token dict callers already pass around,
+    # but every lookup goes through the manager, so long runs pick up a
+    # refreshed token instead of failing once the original one expires.
+    def __init__(self, manager: "TokenManager"):
+        self._manager = manager
+
+    def __getitem__(self, region: str) -> str:
+        if region not in self._manager.regions:
+            raise KeyError(region)
+        return self._manager.access_token(region)
+
+    def __iter__(self):
+        return iter(self._manager.regions)
+
+    def __len__(self):
+        return len(self._manager.regions)
+
+
+class TokenManager:
+    def __init__(
+        self,
+        client_id: str,
+        client_secret: str,
+        regions: list = blizzard.REGIONS,
+        cache_path: str = TOKEN_CACHE_PATH,
+        expiry_margin: float = blizzard.TOKEN_EXPIRY_MARGIN,
+        season_ttl: float = SEASON_TTL,
+    ):
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.regions = list(regions)
+        self.cache_path = cache_path
+        self.expiry_margin = expiry_margin
+        self.season_ttl = season_ttl
+        self.access_tokens = AccessTokens(self)
+        self._entries = {}
+        self._loaded = False
+        self._lock = threading.RLock()
+
+    def bootstrap(self) -> (AccessTokens, dict):
+        with self._lock:
+            self._load()
+            stale_regions = [
+                region
+                for region in self.regions
+                if self._is_token_stale(region) or self._is_season_stale(region)
+            ]
+
+            if stale_regions:
+                with concurrent.futures.ThreadPoolExecutor(
+                    len(stale_regions)
+                ) as executor:
+                    for future in [
+                        executor.submit(self._refresh_region, region)
+                        for region in stale_regions
+                    ]:
+                        future.result()
+                self._save()
+
+            return self.access_tokens, self.current_season_ids()
+
+    def access_token(self, region: str) -> str:
+        entry = self._entries.get(region)
+        if entry is None or self._is_token_stale(region):
+            with self._lock:
+                self._load()
+                if self._is_token_stale(region):
+                    self._refresh_token(region)
+                    self._save()
+                entry = self._entries[region]
+        return entry["access_token"]
+
+    def current_season_ids(self) -> dict:
+        return dict(
+            (region, self._entries[region]["season_id"])
+            for region in self.regions
+            if region in self._entries
+        )
+
+    def _is_token_stale(self, region: str) -> bool:
+        entry = self._entries.get(region)
+        return (
+            not entry
+            or entry.get("client_id") != self.client_id
+            or entry["expires_at"] - self.expiry_margin <= time.time()
+        )
+
+    def _is_season_stale(self, region: str) -> bool:
+        entry = self._entries.get(region)
+        return (
+            not entry
+            or entry.get("season_id") is None
+            or entry.get("season_fetched_at", 0) + self.season_ttl <= time.time()
+        )
+
+    def _refresh_region(self, region: str):
+        if self._is_token_stale(region):
+            self._refresh_token(region)
+        access_token = self._entries[region]["access_token"]
+        season_id = blizzard.get_current_season_data(access_token, region)["id"]
+        self._entries[region].update(
+            {"season_id": season_id, "season_fetched_at": time.time()}
+        )
+
+    def _refresh_token(self, region: str):
+        access_token, expires_at = blizzard.get_access_token(
+            self.client_id, self.client_secret, region
+        )
+        entry = dict(self._entries.get(region) or {})
+        if entry.get("client_id") != self.client_id:
+            entry = {}
+        entry.update(
+            {
+                "client_id": self.client_id,
+                "access_token": access_token,
+                "expires_at": expires_at,
+            }
+        )
+        self._entries[region] = entry
+
+    def _load(self):
+        if self._loaded:
+            return
+        self._loaded = True
+
+        if not self.cache_path:
+            return
+        try:
+            with open(self.cache_path) as cache_file:
+                entries = json.load(cache_file)
+        except (OSError, ValueError):
+            return
+
+        # Keep regions other scripts cached, so sharing the file is harmless.
+        self._entries.update(
+            (region, entry) for region, entry in entries.items() if entry
+        )
+
+    def _save(self):
+        if not self.cache_path:
+            return
+
+        # The file holds credentials, so it is created private and replaced
+        # atomically for other processes reading it.
+        temp_path = self.cache_path + ".tmp"
+        fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as cache_file:
+            json.dump(self._entries, cache_file)
+        os.replace(temp_path, self.cache_path)
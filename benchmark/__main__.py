@@ -0,0 +1,142 @@
+import argparse
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import urllib.request
+
+from benchmark.fakes import Population, FakeServer
+
+MODES = {
+    "threaded": {"THREADED": "true", "ASYNC": "false"},
+    "current_thread": {"THREADED": "false", "ASYNC": "false"},
+    "cpu_process": {"THREADED": "true", "ASYNC": "false", "CPU_EXECUTOR": "process"},
+    "async": {"ASYNC": "true"},
+}
+
+
+def _serve(population_args: tuple, latency: float, throttle_rate: float, queue):
+    server = FakeServer(Population(*population_args), latency, throttle_rate)
+    queue.put(server.url)
+    server.serve_forever()
+
+
+def _call(server_url: str, path: str, method: str = "GET") -> dict:
+    data = b"" if method == "POST" else None
+    request = urllib.request.Request(server_url + path, data=data, method=method)
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read())
+
+
+def run(server_url: str, args, mode: str, pool_size: int) -> dict:
+    _call(server_url, "/_reset", "POST")
+
+    env = dict(os.environ)
+    env.update(MODES[mode])
+    env.update(
+        {
+            "POOL_SIZE": str(pool_size),
+            "BENCHMARK_SERVER_URL": server_url,
+            "BENCHMARK_TEAMS": str(args.teams),
+            "BENCHMARK_MEMBERS": str(args.members),
+            "BENCHMARK_SEED": str(args.seed),
+            "BENCHMARK_RATE_LIMIT": str(args.rate_limit),
+        }
+    )
+    output = subprocess.run(
+        [sys.executable, "-m", "benchmark.worker"],
+        env=env,
+        check=True,
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+    ).stdout
+
+    result = json.loads(output.strip().splitlines()[-1])
+    result["requests"] = _call(server_url, "/_stats")
+    result.update({"mode": mode, "pool_size": pool_size})
+    return result
+
+
+def print_results(results: list):
+    print(
+        "{:<16}{:>6}{:>10}{:>10}{:>10}{:>10}{:>12}".format(
+            "mode", "pool", "wall (s)", "requests", "db reads", "db writes", "rss (MiB)"
+        )
+    )
+    for result in results:
+        print(
+            "{:<16}{:>6}{:>10.2f}{:>10}{:>10}{:>10}{:>12.1f}".format(
+                result["mode"],
+                result["pool_size"],
+                result["wall_seconds"],
+                sum(result["requests"].values()),
+                result["db_reads"],
+                result["db_writes"],
+                result["peak_rss_kb"] / 1024,
+            )
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run update_db against local fakes of Battle.net, Discord "
+        "and Firebase."
+    )
+    parser.add_argument("--teams", type=int, default=50000)
+    parser.add_argument("--members", type=int, default=10000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--throttle-rate", type=float, default=0.0)
+    parser.add_argument(
+        "--rate-limit",
+        type=float,
+        default=0.0,
+        help="client-side requests per second to the fakes, 0 for unlimited",
+    )
+    parser.add_argument(
+        "--modes", default="threaded,current_thread", help=", ".join(MODES)
+    )
+    parser.add_argument("--pool-sizes", default="8,32,64")
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    queue = multiprocessing.Queue()
+    server_process = multiprocessing.Process(
+        target=_serve,
+        args=(
+            (args.teams, args.members, args.seed),
+            args.latency,
+            args.throttle_rate,
+            queue,
+        ),
+        daemon=True,
+    )
+    server_process.start()
+    server_url = queue.get()
+
+    results = []
+    try:
+        for mode in args.modes.split(","):
+            # Without a pool the pool size only bounds request concurrency,
+            # so one run is enough.
+            pool_sizes = [int(x) for x in args.pool_sizes.split(",")]
+            if mode == "current_thread":
+                pool_sizes = pool_sizes[:1]
+
+            for pool_size in pool_sizes:
+                print("Running {} with POOL_SIZE={}".format(mode, pool_size))
+                results.append(run(server_url, args, mode, pool_size))
+    finally:
+        server_process.terminate()
+
+    print()
+    print_results(results)
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,504 @@
+import collections
+import copy
+import http.server
+import json
+import random
+import re
+import threading
+import time
+import urllib.parse
+
+# Kept free of allindb imports so the worker can install the fake database
+# before anything binds firebase_admin.db.reference.
+REGIONS = ["us", "eu", "kr"]
+CURRENT_SEASON_ID = 40
+LADDER_SIZE = 100
+LADDER_ID_STRIDE = 10000
+TIERS_PER_LEAGUE = 3
+RACES = ["Zerg", "Protoss", "Terran", "Random"]
+CLAN_ID = 369458
+OTHER_CLAN_ID = 1
+
+
+class Population:
+    def __init__(
+        self,
+        teams: int,
+        members: int,
+        seed: int = 0,
+        league_ids: list = range(7),
+        regions: list = REGIONS,
+        clan_fraction: float = 0.01,
+        on_ladder_fraction: float = 0.8,
+    ):
+        self.regions = list(regions)
+        self.league_ids = list(league_ids)
+        self.seed = seed
+        self.member_count = members
+        self.clan_fraction = clan_fraction
+        self.on_ladder_fraction = on_ladder_fraction
+        self.teams_per_league = max(
+            1, teams // (len(self.regions) * len(self.league_ids))
+        )
+        self.teams_per_region = self.teams_per_league * len(self.league_ids)
+        self.team_count = self.teams_per_region * len(self.regions)
+
+    def _rng(self, *key) -> random.Random:
+        return random.Random("{}:{}".format(self.seed, ":".join(map(str, key))))
+
+    def ladder_ids(self, league_id: int) -> list:
+        divisions = -(-self.teams_per_league // LADDER_SIZE)
+        return [league_id * LADDER_ID_STRIDE + x + 1 for x in range(divisions)]
+
+    def league_data(self, region: str, league_id: int) -> dict:
+        ladder_ids = self.ladder_ids(league_id)
+        tiers = []
+        for tier_index in range(TIERS_PER_LEAGUE):
+            min_rating, max_rating = self._tier_ratings(league_id, tier_index)
+            tiers.append(
+                {
+                    "id": tier_index,
+                    "min_rating": min_rating,
+                    "max_rating": max_rating,
+                    "division": [
+                        {"ladder_id": ladder_id, "member_count": LADDER_SIZE}
+                        for ladder_id in ladder_ids[tier_index::TIERS_PER_LEAGUE]
+                    ],
+                }
+            )
+        return {"key": {"league_id": league_id}, "tier": tiers}
+
+    def _tier_ratings(self, league_id: int, tier_index: int) -> (int, int):
+        # Tier 0 is the top tier of a league, as in the game data API.
+        league_floor = 1000 + league_id * 600
+        tier_floor = league_floor + (TIERS_PER_LEAGUE - 1 - tier_index) * 200
+        return tier_floor, tier_floor + 199
+
+    def ladder_data(self, region: str, ladder_id: int) -> dict:
+        league_id, division = divmod(ladder_id, LADDER_ID_STRIDE)
+        if league_id not in self.league_ids or not division:
+            return None
+
+        first = (division - 1) * LADDER_SIZE
+        last = min(first + LADDER_SIZE, self.teams_per_league)
+        if first >= last:
+            return None
+
+        region_offset = self.regions.index(region) * self.teams_per_region
+        league_offset = self.league_ids.index(league_id) * self.teams_per_league
+        return {
+            "league": {"league_key": {"league_id": league_id}},
+            "team": [
+                self.team(region_offset + league_offset + x, league_id)
+                for x in range(first, last)
+            ],
+        }
+
+    def team(self, index: int, league_id: int) -> dict:
+        rng = self._rng("team", index)
+        wins = rng.randint(0, 200)
+        losses = rng.randint(0, 200)
+        clan_id = CLAN_ID if rng.random() < self.clan_fraction else OTHER_CLAN_ID
+        profile_id = index + 1
+        return {
+            "id": index,
+            "rating": 1000 + league_id * 600 + rng.randint(0, 599),
+            "points": rng.randint(0, 1000),
+            "wins": wins,
+            "losses": losses,
+            "ties": 0,
+            "longest_win_streak": rng.randint(0, 20),
+            "current_win_streak": rng.randint(0, 5),
+            "last_played_time_stamp": 1600000000 + rng.randint(0, 10000000),
+            "member": [
+                {
+                    "legacy_link": {
+                        "id": profile_id,
+                        "realm": 1,
+                        "name": "Player{}#{}".format(index, profile_id % 1000),
+                        "path": "/profile/{}/1/Player{}".format(profile_id, index),
+                    },
+                    "character_link": {
+                        "id": profile_id,
+                        "battle_tag": self.battle_tag(index),
+                    },
+                    "played_race_count": [
+                        {"race": {"en_US": rng.choice(RACES)}, "count": wins + losses}
+                    ],
+                    "clan_link": {"id": clan_id, "clan_tag": "C{}".format(clan_id)},
+                }
+            ],
+        }
+
+    def battle_tag(self, index: int) -> str:
+        return "Player{}#{}".format(index, 1000 + index % 9000)
+
+    def character_key(self, index: int) -> str:
+        return "{}-1-Player{}".format(index + 1, index)
+
+    def locate_team(self, index: int) -> (str, int, int):
+        region_index, remainder = divmod(index, self.teams_per_region)
+        league_index, position = divmod(remainder, self.teams_per_league)
+        league_id = self.league_ids[league_index]
+        ladder_id = league_id * LADDER_ID_STRIDE + position // LADDER_SIZE + 1
+        return self.regions[region_index], league_id, ladder_id
+
+    def profile_ladder_data(self, region: str, profile_id: int) -> dict:
+        index = profile_id - 1
+        if not 0 <= index < self.team_count:
+            return {"currentSeason": []}
+
+        team_region, _, ladder_id = self.locate_team(index)
+        if team_region != region:
+            return {"currentSeason": []}
+
+        return {
+            "currentSeason": [
+                {"ladder": [{"ladderId": ladder_id, "matchMakingQueue": "LOTV_SOLO"}]}
+            ]
+        }
+
+    def member_key(self, member_index: int) -> str:
+        return str(100000000000000000 + member_index)
+
+    def members(self) -> dict:
+        members = {}
+        for member_index in range(self.member_count):
+            rng = self._rng("member", member_index)
+
+            if rng.random() < self.on_ladder_fraction:
+                index = rng.randrange(self.team_count)
+                region, league_id, _ = self.locate_team(index)
+                battle_tag = self.battle_tag(index)
+                character_key = self.character_key(index)
+            else:
+                # Characters with no ladder team this season, which only the
+                # legacy profile lookup can resolve.
+                index = self.team_count + member_index
+                region = rng.choice(self.regions)
+                league_id = rng.choice(self.league_ids)
+                battle_tag = "Member{}#{}".format(member_index, 1000 + member_index)
+                character_key = self.character_key(index)
+
+            race = rng.choice(RACES)
+            members[self.member_key(member_index)] = {
+                "battle_tag": battle_tag,
+                "caseless_battle_tag": urllib.parse.quote(battle_tag.casefold()),
+                "characters": {
+                    region: {
+                        character_key: {
+                            "ladder_info": {
+                                str(CURRENT_SEASON_ID - 1): {
+                                    race: {
+                                        "league_id": league_id,
+                                        "games_played": rng.randint(1, 300),
+                                    }
+                                }
+                            }
+                        }
+                    }
+                },
+            }
+        return members
+
+    def guild_members(self) -> list:
+        return [
+            {
+                "user": {
+                    "id": self.member_key(member_index),
+                    "username": "member{}".format(member_index),
+                },
+                "nick": "",
+                "roles": ["full_member"] if member_index % 2 else [],
+            }
+            for member_index in range(self.member_count)
+        ]
+
+
+class FakeServer:
+    def __init__(
+        self,
+        population: Population,
+        latency: float = 0.0,
+        throttle_rate: float = 0.0,
+        retry_after: float = 0.1,
+        host: str = "127.0.0.1",
+        port: int = 0,
+    ):
+        self.population = population
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.requests = collections.Counter()
+        self._lock = threading.Lock()
+        self._guild_members = population.guild_members()
+        self._guild_member_ids = [x["user"]["id"] for x in self._guild_members]
+        self._server = http.server.ThreadingHTTPServer(
+            (host, port), _make_handler(self)
+        )
+        self._server.daemon_threads = True
+
+    @property
+    def url(self) -> str:
+        return "http://{}:{}".format(*self._server.server_address[:2])
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def shutdown(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self.requests)
+
+    def reset(self):
+        with self._lock:
+            self.requests.clear()
+
+    def _count(self, route: str):
+        with self._lock:
+            self.requests[route] += 1
+
+    def _throttled(self) -> bool:
+        return self.throttle_rate and random.random() < self.throttle_rate
+
+    def handle_get(self, path: str, query: dict) -> (str, object):
+        match = re.match(r"^/(\w+)/data/sc2/season/current$", path)
+        if match:
+            return "season", {"id": CURRENT_SEASON_ID}
+
+        match = re.match(r"^/(\w+)/data/sc2/league/\d+/201/0/(\d+)$", path)
+        if match:
+            region, league_id = match.group(1), int(match.group(2))
+            if league_id not in self.population.league_ids:
+                return "league", None
+            return "league", self.population.league_data(region, league_id)
+
+        match = re.match(r"^/(\w+)/data/sc2/ladder/(\d+)$", path)
+        if match:
+            region, ladder_id = match.group(1), int(match.group(2))
+            return "ladder", self.population.ladder_data(region, ladder_id)
+
+        match = re.match(r"^/(\w+)/sc2/legacy/profile/\d+/\d+/(\d+)/ladders$", path)
+        if match:
+            region, profile_id = match.group(1), int(match.group(2))
+            return (
+                "legacy_profile",
+                self.population.profile_ladder_data(region, profile_id),
+            )
+
+        match = re.match(r"^/discord/guilds/[^/]+/members$", path)
+        if match:
+            limit = int(query.get("limit", ["1"])[0])
+            after = query.get("after", ["0"])[0]
+            start = _bisect_ids(self._guild_member_ids, after)
+            return "guild_members", self._guild_members[start : start + limit]
+
+        match = re.match(r"^/discord/guilds/[^/]+/members/(\d+)$", path)
+        if match:
+            start = _bisect_ids(self._guild_member_ids, str(int(match.group(1)) - 1))
+            if (
+                start < len(self._guild_member_ids)
+                and self._guild_member_ids[start] == match.group(1)
+            ):
+                return "guild_member", self._guild_members[start]
+            return "guild_member", None
+
+        return "unknown", None
+
+
+def _bisect_ids(ids: list, after: str) -> int:
+    # Snowflakes compare numerically; the synthetic ones all share a length.
+    low, high = 0, len(ids)
+    while low < high:
+        middle = (low + high) // 2
+        if int(ids[middle]) <= int(after):
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+
+def _make_handler(server: FakeServer):
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            return
+
+        def _send_json(self, status: int, body, headers: dict = None):
+            data = json.dumps(body).encode("utf8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _respond(self, route: str, body):
+            server._count(route)
+            if server.latency:
+                time.sleep(server.latency)
+
+            if server._throttled():
+                server._count("throttled")
+                self._send_json(
+                    429,
+                    {"retry_after": server.retry_after},
+                    {"Retry-After": str(server.retry_after)},
+                )
+            elif body is None:
+                self._send_json(404, {})
+            else:
+                self._send_json(200, body)
+
+        def do_GET(self):
+            url = urllib.parse.urlsplit(self.path)
+
+            if url.path == "/_stats":
+                self._send_json(200, server.stats())
+                return
+
+            route, body = server.handle_get(url.path, urllib.parse.parse_qs(url.query))
+            self._respond(route, body)
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+            if self.path == "/_reset":
+                server.reset()
+                self._send_json(200, {})
+            elif re.match(r"^/(\w+)/oauth/token$", self.path):
+                self._respond(
+                    "token", {"access_token": "benchmark", "expires_in": 86400}
+                )
+            else:
+                self._send_json(404, {})
+
+    return Handler
+
+
+class FakeDatabase:
+    def __init__(self, data: dict = None):
+        self.data = data or {}
+        self.reads = 0
+        self.writes = 0
+        self.write_paths = 0
+        self._lock = threading.Lock()
+
+    def reference(self, path: str = "") -> "FakeReference":
+        return FakeReference(self, _split_path(path))
+
+    def _node(self, segments: list):
+        node = self.data
+        for segment in segments:
+            if not isinstance(node, dict) or segment not in node:
+                return None
+            node = node[segment]
+        return node
+
+    def _put(self, segments: list, value):
+        if not segments:
+            self.data = copy.deepcopy(value) if isinstance(value, dict) else {}
+            return
+
+        parent = self.data
+        for segment in segments[:-1]:
+            if not isinstance(parent.get(segment), dict):
+                parent[segment] = {}
+            parent = parent[segment]
+
+        if value is None:
+            parent.pop(segments[-1], None)
+        else:
+            parent[segments[-1]] = copy.deepcopy(value)
+
+
+class FakeReference:
+    def __init__(self, database: FakeDatabase, segments: list, query: dict = None):
+        self._database = database
+        self._segments = segments
+        self._query = query or {}
+
+    def child(self, path) -> "FakeReference":
+        return FakeReference(self._database, self._segments + _split_path(str(path)))
+
+    def _with_query(self, **query) -> "FakeReference":
+        return FakeReference(self._database, self._segments, {**self._query, **query})
+
+    def order_by_key(self) -> "FakeReference":
+        return self._with_query(order_by="$key")
+
+    def order_by_child(self, path: str) -> "FakeReference":
+        return self._with_query(order_by=path)
+
+    def start_at(self, start) -> "FakeReference":
+        return self._with_query(start_at=start)
+
+    def equal_to(self, value) -> "FakeReference":
+        return self._with_query(equal_to=value)
+
+    def limit_to_first(self, limit: int) -> "FakeReference":
+        return self._with_query(limit_to_first=limit)
+
+    def get(self, shallow: bool = False):
+        with self._database._lock:
+            self._database.reads += 1
+            node = self._database._node(self._segments)
+
+            if not isinstance(node, dict):
+                return copy.deepcopy(node)
+            if shallow:
+                return dict.fromkeys(node, True)
+            if not self._query:
+                return copy.deepcopy(node)
+
+            items = sorted(node.items())
+            order_by = self._query.get("order_by")
+            if order_by not in (None, "$key"):
+                items = [
+                    (key, value)
+                    for key, value in items
+                    if isinstance(value, dict)
+                    and value.get(order_by) == self._query.get("equal_to")
+                ]
+            if "start_at" in self._query:
+                items = [(k, v) for k, v in items if k >= self._query["start_at"]]
+            if "limit_to_first" in self._query:
+                items = items[: self._query["limit_to_first"]]
+
+            return collections.OrderedDict(
+                (key, copy.deepcopy(value)) for key, value in items
+            )
+
+    def set(self, value):
+        with self._database._lock:
+            self._database.writes += 1
+            self._database.write_paths += 1
+            self._database._put(self._segments, value)
+
+    def delete(self):
+        self.set(None)
+
+    def update(self, value: dict):
+        paths = [_split_path(path) for path in value]
+        for path in paths:
+            for other in paths:
+                if path != other and other[: len(path)] == path:
+                    raise ValueError("Conflicting update paths")
+
+        with self._database._lock:
+            self._database.writes += 1
+            self._database.write_paths += len(value)
+            for path, child_value in zip(paths, value.values()):
+                self._database._put(self._segments + path, child_value)
+
+
+def _split_path(path: str) -> list:
+    return [segment for segment in path.split("/") if segment]
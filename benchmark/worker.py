@@ -0,0 +1,78 @@
+import contextlib
+import json
+import os
+import resource
+import sys
+import time
+import urllib.parse
+
+import firebase_admin
+import firebase_admin.credentials
+import firebase_admin.db
+
+from benchmark.fakes import Population, FakeDatabase
+
+# Effectively no client-side throttling, so the run measures our own code
+# rather than the production rate limits.
+UNLIMITED_RATE = ((1e9, 10 ** 9),)
+
+
+def main():
+    server_url = os.environ["BENCHMARK_SERVER_URL"]
+    rate_limit = float(os.getenv("BENCHMARK_RATE_LIMIT", "0"))
+    population = Population(
+        int(os.getenv("BENCHMARK_TEAMS", "50000")),
+        int(os.getenv("BENCHMARK_MEMBERS", "10000")),
+        int(os.getenv("BENCHMARK_SEED", "0")),
+    )
+
+    database = FakeDatabase({"members": population.members()})
+    firebase_admin.initialize_app = lambda *args, **kwargs: None
+    firebase_admin.credentials.Certificate = lambda *args, **kwargs: None
+    firebase_admin.db.reference = database.reference
+
+    os.environ.setdefault("FIREBASE_CONFIG", "{}")
+    os.environ.setdefault("GUILD_ID", "benchmark")
+    os.environ.setdefault("FULL_MEMBER_ROLE_ID", "full_member")
+    os.environ.setdefault("DISCORD_BOT_TOKEN", "benchmark")
+    # Nothing may carry over between runs, or later modes would start ahead.
+    os.environ.setdefault("HTTP_CACHE_PATH", "")
+    os.environ.setdefault("TOKEN_CACHE_PATH", "")
+    os.environ.setdefault("JOURNAL_PATH", "")
+
+    import allindb.blizzard
+    import allindb.discord
+    import allindb.ratelimit
+
+    allindb.blizzard.GAME_DATA_URL_TEMPLATE = server_url + "/{}/data/sc2"
+    allindb.blizzard.COMMUNITY_URL_TEMPLATE = server_url + "/{}/sc2"
+    allindb.blizzard.OAUTH_URL_TEMPLATE = server_url + "/{}/oauth/token"
+    allindb.discord.API_URL = server_url + "/discord"
+    allindb.ratelimit.scheduler.rate_limits = {
+        urllib.parse.urlsplit(server_url).netloc: (
+            ((rate_limit, int(rate_limit)),) if rate_limit else UNLIMITED_RATE
+        )
+    }
+
+    import update_db
+
+    start = time.monotonic()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        update_db.main()
+    wall_seconds = time.monotonic() - start
+
+    json.dump(
+        {
+            "wall_seconds": wall_seconds,
+            "db_reads": database.reads,
+            "db_writes": database.writes,
+            "db_write_paths": database.write_paths,
+            "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        },
+        sys.stdout,
+    )
+    print()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,33 @@
+import asyncio
 import concurrent.futures
 import itertools
-import functools
 import json
 import os
+import queue
 import random
+import signal
+import sys
+import threading
+import time
+import traceback
 
 import firebase_admin
 import firebase_admin.credentials
 from firebase_admin.db import reference
 
+import allindb.aio
 import allindb.blizzard
 import allindb.discord
 import allindb.executor
+import allindb.export
+import allindb.firebase
+import allindb.httpcache
+import allindb.journal
+import allindb.ratelimit
+import allindb.sharding
+import allindb.sweep
+import allindb.tokens
+from allindb.metrics import metrics
 
 CLIENT_ID = os.getenv("BATTLE_NET_CLIENT_ID", "")
 CLIENT_SECRET = os.getenv("BATTLE_NET_CLIENT_SECRET", "")
@@ -21,9 +37,41 @@ FULL_MEMBER_ROLE_ID = os.getenv("FULL_MEMBER_ROLE_ID", "")
 API_KEY = os.getenv("BATTLE_NET_API_KEY", "")
 FIREBASE_CONFIG = json.loads(os.getenv("FIREBASE_CONFIG", {}))
 POOL_SIZE = int(os.getenv("POOL_SIZE", "32"))
+BATCH_SIZE = int(os.getenv("BATCH_SIZE", "500"))
+SNAPSHOT = os.getenv("SNAPSHOT", "true").casefold() == "true".casefold()
+SNAPSHOT_PAGE_SIZE = int(os.getenv("SNAPSHOT_PAGE_SIZE", "1000"))
+LADDER_CACHE_SIZE = int(os.getenv("LADDER_CACHE_SIZE", "4096"))
+SWEEP_CONCURRENCY_PER_REGION = int(os.getenv("SWEEP_CONCURRENCY_PER_REGION", "10"))
 LEAGUE_IDS = range(7)
 CLAN_IDS = [369458, 40715, 406747]
 THREADED = os.getenv("THREADED", "true").casefold() == "true".casefold()
+EXECUTOR = os.getenv("EXECUTOR", "thread" if THREADED else "current_thread")
+MAX_PENDING = int(os.getenv("MAX_PENDING", str(POOL_SIZE * 4)))
+FETCH_POOL_SIZE = int(os.getenv("FETCH_POOL_SIZE", str(POOL_SIZE)))
+CPU_EXECUTOR = os.getenv("CPU_EXECUTOR", "")
+CPU_POOL_SIZE = int(os.getenv("CPU_POOL_SIZE", str(os.cpu_count() or 1)))
+MEMBER_TIMEOUT = float(os.getenv("MEMBER_TIMEOUT", "0"))
+ASYNC = os.getenv("ASYNC", "false").casefold() == "true".casefold()
+MAX_IN_FLIGHT_PER_HOST = int(os.getenv("MAX_IN_FLIGHT_PER_HOST", "64"))
+INCREMENTAL = os.getenv("INCREMENTAL", "false").casefold() == "true".casefold()
+HTTP_CACHE_PATH = os.getenv("HTTP_CACHE_PATH", "http_cache.sqlite")
+TOKEN_CACHE_PATH = os.getenv("TOKEN_CACHE_PATH", "token_cache.json")
+DISCORD_BULK = os.getenv("DISCORD_BULK", "true").casefold() == "true".casefold()
+METRICS_PATH = os.getenv("METRICS_PATH", "")
+PROMETHEUS_PATH = os.getenv("PROMETHEUS_PATH", "")
+DAEMON = os.getenv("DAEMON", "false").casefold() == "true".casefold()
+SWEEP_INTERVAL = float(os.getenv("SWEEP_INTERVAL", str(60 * 60)))
+ACTIVE_MEMBER_INTERVAL = float(os.getenv("ACTIVE_MEMBER_INTERVAL", str(10 * 60)))
+SHARD = allindb.sharding.Shard.parse(os.getenv("SHARD", ""))
+SWEEP_PATH = os.getenv("SWEEP_PATH", "")
+SWEEP_OUTPUT_PATH = os.getenv("SWEEP_OUTPUT_PATH", "")
+# Checkpointing saves the whole player index after the sweep, which takes
+# seconds on a full ladder, so it is opt-in.
+JOURNAL_PATH = os.getenv("JOURNAL_PATH", "")
+EXPORT_PATH = os.getenv("EXPORT_PATH", "")
+JOURNAL_MAX_AGE = float(
+    os.getenv("JOURNAL_MAX_AGE", str(allindb.journal.JOURNAL_MAX_AGE))
+)
 
 firebase_admin.initialize_app(
     credential=firebase_admin.credentials.Certificate(
@@ -32,6 +80,26 @@ firebase_admin.initialize_app(
     options=FIREBASE_CONFIG,
 )
 
+token_manager = allindb.tokens.TokenManager(
+    CLIENT_ID, CLIENT_SECRET, cache_path=TOKEN_CACHE_PATH
+)
+
+# A member's profile and ladder fetches fan out here rather than into the
+# main pool, whose threads the member tasks themselves are holding.
+fetch_executor = (
+    concurrent.futures.ThreadPoolExecutor(FETCH_POOL_SIZE)
+    if EXECUTOR == "thread" and FETCH_POOL_SIZE
+    else None
+)
+
+# Shards sharing a host keep a journal each.
+journal = allindb.journal.Journal(
+    "{}.shard-{}".format(JOURNAL_PATH, SHARD.index)
+    if JOURNAL_PATH and SHARD.count > 1
+    else JOURNAL_PATH,
+    JOURNAL_MAX_AGE,
+)
+
 
 def _flatten(l) -> list:
     return list(itertools.chain.from_iterable(l))
@@ -41,132 +109,874 @@ def for_each_discord_member(
     access_tokens_per_region: dict,
     current_season_id_per_region: dict,
     mmrs_per_region: dict,
+    player_index: allindb.blizzard.PlayerIndex,
     member_key: str,
+    member_data: dict = None,
 ):
+    if member_data is None:
+        member_data = allindb.firebase.get_member(member_key)
+
+    batch = allindb.firebase.WriteBatch(max_size=0)
+
     allindb.blizzard.update_characters_for_member(
         access_tokens_per_region,
         current_season_id_per_region,
         mmrs_per_region,
+        player_index,
+        member_key,
+        member_data,
+        batch,
+        INCREMENTAL,
+        fetch_executor,
+    )
+    print("updated characters for member with id " + member_key)
+
+    batch.apply_to({"members": {member_key: member_data}})
+    allindb.blizzard.update_ladder_summary_for_member(
+        current_season_id_per_region, member_key, member_data, batch, INCREMENTAL
+    )
+    batch.commit()
+    print("Updated ladder summary for member with id " + member_key)
+    journal.record_member(member_key)
+
+    return member_data
+
+
+async def for_each_discord_member_async(
+    engine: allindb.aio.AsyncHttpEngine,
+    access_tokens_per_region: dict,
+    current_season_id_per_region: dict,
+    mmrs_per_region: dict,
+    player_index: allindb.blizzard.PlayerIndex,
+    member_key: str,
+    member_data: dict = None,
+):
+    if member_data is None:
+        member_data = await asyncio.to_thread(allindb.firebase.get_member, member_key)
+
+    batch = allindb.firebase.WriteBatch(max_size=0)
+
+    await allindb.aio.update_characters_for_member(
+        engine,
+        access_tokens_per_region,
+        current_season_id_per_region,
+        mmrs_per_region,
+        player_index,
         member_key,
+        member_data,
+        batch,
+        INCREMENTAL,
     )
     print("updated characters for member with id " + member_key)
 
+    batch.apply_to({"members": {member_key: member_data}})
     allindb.blizzard.update_ladder_summary_for_member(
-        current_season_id_per_region, member_key
+        current_season_id_per_region, member_key, member_data, batch, INCREMENTAL
     )
+    await asyncio.to_thread(batch.commit)
     print("Updated ladder summary for member with id " + member_key)
+    journal.record_member(member_key)
+
+    return member_data
 
 
 def update_discord_info_for_members(discord_member_keys: list):
+    batch = allindb.firebase.WriteBatch(BATCH_SIZE)
+
+    if DISCORD_BULK:
+        unknown_member_keys = allindb.discord.update_discord_info_for_members_in_bulk(
+            DISCORD_BOT_TOKEN, GUILD_ID, FULL_MEMBER_ROLE_ID, discord_member_keys, batch
+        )
+        for member_key in unknown_member_keys:
+            print("Unknown member: " + member_key)
+        batch.commit()
+        print("Updated discord info for members.")
+        return
+
     for member_key in discord_member_keys:
         allindb.discord.update_discord_info_for_member(
-            DISCORD_BOT_TOKEN, GUILD_ID, FULL_MEMBER_ROLE_ID, member_key
+            DISCORD_BOT_TOKEN, GUILD_ID, FULL_MEMBER_ROLE_ID, member_key, batch
         )
         print("Updated discord info for member with id " + member_key)
+    batch.commit()
+
+
+def update_unregistered_clan_members_for_region(
+    region: str,
+    current_season_id: int,
+    mmrs: allindb.blizzard.MmrDistribution,
+    clan_members: list,
+    clan_member_index: allindb.blizzard.ClanMemberIndex,
+):
+    if journal.stage("unregistered_update/" + region):
+        return
+
+    # Regions are updated concurrently, so each is timed separately.
+    with metrics.stage("unregistered_update/" + region):
+        batch = allindb.firebase.WriteBatch(BATCH_SIZE)
+        ratings = [clan_member.rating for clan_member in clan_members]
+        for clan_member, percentile, tier in zip(
+            clan_members, mmrs.percentiles(ratings), mmrs.tiers(ratings)
+        ):
+            allindb.blizzard.update_unregistered_member_ladder_summary_for_member(
+                region,
+                current_season_id,
+                percentile,
+                clan_member,
+                clan_member_index,
+                batch,
+                tier,
+                SHARD,
+            )
+        if mmrs.tier_boundaries and SHARD.index == 0:
+            batch.set(
+                allindb.firebase.join_path(
+                    "tier_boundaries", region, current_season_id
+                ),
+                mmrs.tier_boundaries.to_dict(),
+            )
+        allindb.blizzard.purge_non_member_unregistered_members(
+            region, clan_members, clan_member_index, batch, SHARD
+        )
+        batch.commit()
+    journal.record_stage("unregistered_update/" + region)
 
 
 def update_unregistered_clan_members(
     current_season_id_per_region: dict,
     mmrs_per_region: dict,
     clan_members_per_region: dict,
-    executor,
+    clan_member_index: allindb.blizzard.ClanMemberIndex,
 ):
     for region in clan_members_per_region.keys():
-        concurrent.futures.wait(
-            [
-                executor.submit(
-                    allindb.blizzard.update_unregistered_member_ladder_summary_for_member,
-                    region,
-                    current_season_id_per_region[region],
-                    mmrs_per_region[region],
-                    clan_member,
-                )
-                for clan_member in clan_members_per_region[region]
-            ]
-        )
-        allindb.blizzard.purge_non_member_unregistered_members(
-            region, clan_members_per_region[region]
+        update_unregistered_clan_members_for_region(
+            region,
+            current_season_id_per_region[region],
+            mmrs_per_region[region],
+            clan_members_per_region[region],
+            clan_member_index,
         )
 
 
-def main():
-    access_tokens_per_region, current_season_id_per_region = allindb.blizzard.get_access_token_and_current_season_per_region(
-        CLIENT_ID, CLIENT_SECRET
+def get_members() -> dict:
+    with metrics.stage("member_fetch"):
+        if SNAPSHOT:
+            return allindb.firebase.get_members_snapshot(SNAPSHOT_PAGE_SIZE)
+
+        metrics.increment("firebase_reads_total", "members")
+        return dict.fromkeys(reference().child("members").get(shallow=True) or {})
+
+
+def _member_keys_in_shard(members: dict) -> list:
+    return [member_key for member_key in members.keys() if member_key in SHARD]
+
+
+def _regions_for_member(member_data: dict) -> set:
+    # A member that hasn't been read yet could have characters anywhere.
+    if member_data is None:
+        return set(allindb.blizzard.REGIONS)
+    return set(member_data.get("characters") or {})
+
+
+def _update_discord_info_for_fetched_members(
+    members_future: concurrent.futures.Future,
+):
+    discord_member_keys = _member_keys_in_shard(members_future.result())
+    if journal.stage("discord_update"):
+        return
+
+    with metrics.stage("discord_update"):
+        update_discord_info_for_members(discord_member_keys)
+    journal.record_stage("discord_update")
+
+
+def _build_clan_member_index_for_fetched_members(
+    members_future: concurrent.futures.Future,
+) -> allindb.blizzard.ClanMemberIndex:
+    return allindb.blizzard.build_clan_member_index(members_future.result())
+
+
+def _update_unregistered_clan_members_for_region_when_indexed(
+    region: str,
+    current_season_id: int,
+    mmrs: allindb.blizzard.MmrDistribution,
+    clan_members: list,
+    clan_member_index_future: concurrent.futures.Future,
+):
+    update_unregistered_clan_members_for_region(
+        region,
+        current_season_id,
+        mmrs,
+        clan_members,
+        clan_member_index_future.result(),
     )
+
+
+def write_metrics():
+    if METRICS_PATH:
+        metrics.write_json(METRICS_PATH)
+    if PROMETHEUS_PATH:
+        metrics.write_prometheus(PROMETHEUS_PATH)
+
+
+async def main_async():
+    (
+        access_tokens_per_region,
+        current_season_id_per_region,
+    ) = await asyncio.to_thread(_get_access_tokens_and_current_seasons)
     clan_ids_per_region = {"us": CLAN_IDS}
+    sweep = await asyncio.to_thread(_open_run, current_season_id_per_region)
+    player_index = allindb.blizzard.PlayerIndex()
+    if sweep is not None:
+        player_index = sweep[2]
 
-    with concurrent.futures.ThreadPoolExecutor(POOL_SIZE) as executor:
+    # As in update(), a sweep carrying the members has had its Discord sync
+    # and unregistered members done already.
+    shared_members = sweep[3] if sweep is not None else None
 
-        if not THREADED:
-            executor = allindb.executor.CurrentThreadExecutor()
+    async with allindb.aio.AsyncHttpEngine(MAX_IN_FLIGHT_PER_HOST) as engine:
+        if shared_members is not None:
+            members_task = asyncio.get_running_loop().create_future()
+            members_task.set_result(shared_members)
+        else:
+            members_task = asyncio.ensure_future(asyncio.to_thread(get_members))
 
-        mmrs_per_region_per_league, clan_members_per_region_per_league = zip(
-            *executor.map(
-                functools.partial(
-                    allindb.blizzard.fetch_mmrs_and_clan_members_for_each_league,
+        async def update_discord_info():
+            if shared_members is not None:
+                return
+            members = await members_task
+            if DISCORD_BULK:
+                await asyncio.to_thread(
+                    _update_discord_info_for_fetched_members, members_task
+                )
+                return
+            if journal.stage("discord_update"):
+                return
+
+            with metrics.stage("discord_update"):
+                batch = allindb.firebase.WriteBatch(max_size=0)
+                await asyncio.gather(
+                    *(
+                        allindb.aio.update_discord_info_for_member(
+                            engine,
+                            DISCORD_BOT_TOKEN,
+                            GUILD_ID,
+                            FULL_MEMBER_ROLE_ID,
+                            member_key,
+                            batch,
+                        )
+                        for member_key in _member_keys_in_shard(members)
+                    )
+                )
+                await asyncio.to_thread(batch.commit)
+            journal.record_stage("discord_update")
+
+        discord_task = asyncio.ensure_future(update_discord_info())
+
+        if sweep is not None:
+            mmrs_per_region, clan_members_per_region, _, _ = sweep
+        else:
+            with metrics.stage("league_sweep"):
+                (
+                    mmrs_per_region,
+                    clan_members_per_region,
+                ) = await allindb.aio.fetch_mmrs_and_clan_members_for_each_region(
+                    engine,
                     access_tokens_per_region,
                     current_season_id_per_region,
                     clan_ids_per_region,
-                ),
-                LEAGUE_IDS,
+                    player_index,
+                    LEAGUE_IDS,
+                )
+            await asyncio.to_thread(
+                _checkpoint_sweep,
+                current_season_id_per_region,
+                mmrs_per_region,
+                clan_members_per_region,
+                player_index,
+            )
+
+        print("Fetched MMRs and clan members.")
+
+        members = await members_task
+        member_keys = _pending_member_keys(members)
+
+        def update_unregistered_members():
+            _update_unregistered_members_with_all_members(
+                map,
+                current_season_id_per_region,
+                mmrs_per_region,
+                clan_members_per_region,
+                members,
+            )
+
+        unregistered_task = None
+        if SNAPSHOT and shared_members is None:
+            unregistered_task = asyncio.ensure_future(
+                asyncio.to_thread(update_unregistered_members)
             )
+
+        with metrics.stage("member_update"):
+            member_tasks = dict(
+                (
+                    member,
+                    asyncio.ensure_future(
+                        for_each_discord_member_async(
+                            engine,
+                            access_tokens_per_region,
+                            current_season_id_per_region,
+                            mmrs_per_region,
+                            player_index,
+                            member,
+                            members[member],
+                        )
+                    ),
+                )
+                for member in member_keys
+            )
+            if member_tasks:
+                await asyncio.wait(member_tasks.values())
+        failed_member_keys = _collect_member_results(member_tasks, members)
+
+        await discord_task
+        print("Updated registered members.")
+
+    if unregistered_task is not None:
+        await unregistered_task
+    elif shared_members is None:
+        await asyncio.to_thread(update_unregistered_members)
+    print("Updated unregistered members.")
+
+    _finish_run(failed_member_keys)
+
+
+def _open_run(current_season_id_per_region: dict) -> tuple:
+    sweep = None
+    if SWEEP_PATH:
+        sweep = _load_sweep(SWEEP_PATH, current_season_id_per_region)
+
+    journal.open(current_season_id_per_region)
+    if sweep is None and journal.stage("league_sweep"):
+        sweep = _load_sweep(journal.sweep_path, current_season_id_per_region)
+    return sweep
+
+
+def _pending_member_keys(members: dict) -> list:
+    member_keys = [
+        x for x in _member_keys_in_shard(members) if not journal.is_processed(x)
+    ]
+    random.shuffle(member_keys)
+    print("Fetched members.")
+    return member_keys
+
+
+def _update_unregistered_members_with_all_members(
+    map_members,
+    current_season_id_per_region: dict,
+    mmrs_per_region: dict,
+    clan_members_per_region: dict,
+    members: dict,
+):
+    # Without a snapshot the battle tags are only known once every member has
+    # been read, including those this run skipped: ones the journal had done,
+    # ones that failed and other shards' members.
+    unread_member_keys = [x for x, data in members.items() if data is None]
+    members.update(
+        zip(
+            unread_member_keys,
+            map_members(allindb.firebase.get_member, unread_member_keys),
         )
+    )
+    update_unregistered_clan_members(
+        current_season_id_per_region,
+        mmrs_per_region,
+        clan_members_per_region,
+        allindb.blizzard.build_clan_member_index(members),
+    )
+
 
-        mmrs_per_region = functools.reduce(
-            lambda a, b: {
-                region: a.get(region, []) + b.get(region, []) for region in a.keys()
-            },
-            mmrs_per_region_per_league,
-            dict.fromkeys(access_tokens_per_region.keys(), []),
+def _finish_run(failed_member_keys: list):
+    # Failed members stay unrecorded, so a rerun picks up just those.
+    if failed_member_keys:
+        print(
+            "{} members failed, rerun to retry them.".format(len(failed_member_keys))
         )
-        for region in mmrs_per_region:
-            mmrs_per_region[region].sort()
+    else:
+        journal.finish()
+
+
+def update(
+    executor: allindb.executor.InstrumentedExecutor,
+    access_tokens_per_region: dict,
+    current_season_id_per_region: dict,
+    sweep: tuple = None,
+) -> (dict, dict):
+    clan_ids_per_region = {"us": CLAN_IDS}
+    player_index = allindb.blizzard.PlayerIndex()
+    if sweep is not None:
+        player_index = sweep[2]
 
-        clan_members_per_region = functools.reduce(
-            lambda a, b: {
-                region: a.get(region, []) + b.get(region, []) for region in a.keys()
-            },
-            clan_members_per_region_per_league,
-            dict.fromkeys(access_tokens_per_region.keys(), []),
+    high_priority_executor = executor.with_options(allindb.executor.PRIORITY_HIGH)
+    member_executor = executor.with_options(
+        allindb.executor.PRIORITY_NORMAL, MEMBER_TIMEOUT or None
+    )
+    low_priority_executor = executor.with_options(allindb.executor.PRIORITY_LOW)
+
+    # Only percentiles need the finished sweep, so the member read, the
+    # Discord sync and the clan member index start straight away. Tasks
+    # start in priority then submission order, so a task waiting on an
+    # earlier one of at least its priority is never queued behind it.
+    # A sweep from sweep_only carries the members, and its process has already
+    # done the Discord sync and the unregistered members for every shard.
+    shared_members = sweep[3] if sweep is not None else None
+    clan_member_index_future = None
+    if shared_members is not None:
+        members_future = concurrent.futures.Future()
+        members_future.set_result(shared_members)
+        discord_future = None
+    else:
+        members_future = high_priority_executor.submit(get_members)
+        discord_future = low_priority_executor.submit(
+            _update_discord_info_for_fetched_members, members_future
+        )
+    if SNAPSHOT and shared_members is None:
+        clan_member_index_future = high_priority_executor.submit(
+            _build_clan_member_index_for_fetched_members, members_future
         )
 
-        print("Fetched MMRs and clan members.")
+    mmrs_per_region = {}
+    member_futures = {}
+    unregistered_futures = []
+    pending_member_keys = None
+    # Members are submitted as regions finish sweeping, so the stage runs
+    # from the first submission until the last member completes.
+    member_update_start = None
+
+    # Submitting blocks once MAX_PENDING tasks are queued, so members are
+    # submitted from a thread of their own and the sweep loop, which has the
+    # other regions' divisions to queue, never waits on them.
+    ready_members = queue.Queue()
+
+    def submit_members():
+        nonlocal member_update_start
+        for member, member_data in iter(ready_members.get, None):
+            if member_update_start is None:
+                member_update_start = time.monotonic()
+            member_futures[member] = member_executor.submit(
+                for_each_discord_member,
+                access_tokens_per_region,
+                current_season_id_per_region,
+                mmrs_per_region,
+                player_index,
+                member,
+                member_data,
+            )
+
+    member_submitter = threading.Thread(target=submit_members, daemon=True)
+    member_submitter.start()
+
+    def submit_ready_members(force: bool = False):
+        nonlocal pending_member_keys
+        if not force and not members_future.done():
+            return
+
+        members = members_future.result()
+        if pending_member_keys is None:
+            pending_member_keys = _pending_member_keys(members)
+
+        waiting_member_keys = []
+        for member in pending_member_keys:
+            if force or _regions_for_member(members[member]) <= set(
+                mmrs_per_region
+            ):
+                ready_members.put((member, members[member]))
+            else:
+                waiting_member_keys.append(member)
+        pending_member_keys = waiting_member_keys
+
+    def on_region_complete(
+        region: str, mmrs: allindb.blizzard.MmrDistribution, clan_members: list
+    ):
+        print("Fetched MMRs and clan members for " + region)
+        mmrs_per_region[region] = mmrs
+        submit_ready_members()
+
+        if clan_member_index_future:
+            unregistered_futures.append(
+                executor.submit(
+                    _update_unregistered_clan_members_for_region_when_indexed,
+                    region,
+                    current_season_id_per_region[region],
+                    mmrs,
+                    clan_members,
+                    clan_member_index_future,
+                )
+            )
+
+    if sweep is not None:
+        # Another process ran the sweep, so every region is ready up front.
+        swept_mmrs_per_region, clan_members_per_region, _, _ = sweep
+        for region, mmrs in swept_mmrs_per_region.items():
+            on_region_complete(region, mmrs, clan_members_per_region[region])
+    else:
+        with metrics.stage("league_sweep"):
+            (
+                swept_mmrs_per_region,
+                clan_members_per_region,
+            ) = allindb.blizzard.fetch_mmrs_and_clan_members_for_each_region(
+                high_priority_executor,
+                access_tokens_per_region,
+                current_season_id_per_region,
+                clan_ids_per_region,
+                player_index,
+                LEAGUE_IDS,
+                SWEEP_CONCURRENCY_PER_REGION,
+                on_region_complete,
+            )
+        _checkpoint_sweep(
+            current_season_id_per_region,
+            swept_mmrs_per_region,
+            clan_members_per_region,
+            player_index,
+        )
+
+    print("Fetched MMRs and clan members.")
+
+    submit_ready_members(force=True)
+    ready_members.put(None)
+    member_submitter.join()
+    members = members_future.result()
+
+    concurrent.futures.wait(member_futures.values())
+    if member_update_start is not None:
+        metrics.add_stage_seconds(
+            "member_update", time.monotonic() - member_update_start
+        )
+    failed_member_keys = _collect_member_results(member_futures, members)
+
+    if discord_future is not None:
+        discord_future.result()
+    print("Updated registered members.")
 
-        discord_member_keys = list(
-            reference().child("members").get(shallow=True).keys()
+    if clan_member_index_future is None and shared_members is None:
+        _update_unregistered_members_with_all_members(
+            executor.map,
+            current_season_id_per_region,
+            mmrs_per_region,
+            clan_members_per_region,
+            members,
         )
-        if not discord_member_keys:
-            discord_member_keys = []
+    for future in unregistered_futures:
+        future.result()
+
+    print("Updated unregistered members.")
+
+    _finish_run(failed_member_keys)
+    return mmrs_per_region, members, player_index
+
+
+def _collect_member_results(member_futures: dict, members: dict) -> list:
+    # Takes finished pool futures and asyncio tasks alike.
+    failed_member_keys = []
+    for member, future in member_futures.items():
+        if future.cancelled() or future.exception():
+            failed_member_keys.append(member)
+            metrics.increment("member_failures_total")
+            print(
+                "Failed to update member with id {}: {}".format(
+                    member,
+                    "cancelled" if future.cancelled() else repr(future.exception()),
+                )
+            )
         else:
-            random.shuffle(discord_member_keys)
-        print("Fetched members.")
+            members[member] = future.result()
+    return failed_member_keys
 
-        concurrent.futures.wait(
-            [
-                executor.submit(
+
+def _is_active_member(member_data: dict) -> bool:
+    return member_data is None or bool(member_data.get("current_season_games_played"))
+
+
+def update_active_members(
+    executor: allindb.executor.InstrumentedExecutor,
+    access_tokens_per_region: dict,
+    current_season_id_per_region: dict,
+    mmrs_per_region: dict,
+    known_member_keys: set,
+    swept_player_index: allindb.blizzard.PlayerIndex,
+) -> set:
+    # Ladders have moved on since the sweep, so the cached ones are dropped
+    # and just the ladders the sweep found active members on are refetched.
+    # New members, and characters the sweep didn't find, go through their
+    # profile instead.
+    allindb.blizzard.ladder_cache.clear()
+
+    members = get_members()
+    shard_member_keys = _member_keys_in_shard(members)
+    new_member_keys = [x for x in shard_member_keys if x not in known_member_keys]
+    member_keys = new_member_keys + [
+        x
+        for x in shard_member_keys
+        if x in known_member_keys and _is_active_member(members[x])
+    ]
+
+    ladder_keys = list(
+        dict.fromkeys(
+            (region, ladder_id)
+            for member_key in member_keys
+            for region, characters in (
+                (members[member_key] or {}).get("characters") or {}
+            ).items()
+            for character in characters
+            for ladder_id in swept_player_index.ladder_ids(region, character)
+        )
+    )
+    with metrics.stage("active_ladder_refetch"):
+        player_index = allindb.blizzard.index_ladders(
+            executor.with_options(allindb.executor.PRIORITY_HIGH),
+            access_tokens_per_region,
+            ladder_keys,
+        )
+
+    member_executor = executor.with_options(
+        allindb.executor.PRIORITY_NORMAL, MEMBER_TIMEOUT or None
+    )
+    with metrics.stage("active_member_update"):
+        member_futures = dict(
+            (
+                member,
+                member_executor.submit(
                     for_each_discord_member,
                     access_tokens_per_region,
                     current_season_id_per_region,
                     mmrs_per_region,
+                    player_index,
                     member,
-                )
-                for member in discord_member_keys
-            ]
+                    members[member],
+                ),
+            )
+            for member in member_keys
         )
+        concurrent.futures.wait(member_futures.values())
+    _collect_member_results(member_futures, members)
 
-        update_discord_info_for_members(discord_member_keys)
+    if new_member_keys:
+        update_discord_info_for_members(new_member_keys)
 
-        print("Updated registered members.")
+    print("Updated {} active members.".format(len(member_keys)))
+    return set(members.keys())
 
-        update_unregistered_clan_members(
-            current_season_id_per_region,
+
+def _get_access_tokens_and_current_seasons() -> (dict, dict):
+    with metrics.stage("token_fetch"):
+        return token_manager.bootstrap()
+
+
+def sweep_only(
+    executor: allindb.executor.InstrumentedExecutor,
+    access_tokens_per_region: dict,
+    current_season_id_per_region: dict,
+):
+    # The members tree, the Discord sync and the unregistered members cover
+    # everyone, so they are done here once and the members go in the sweep,
+    # rather than every shard repeating them.
+    members_future = executor.with_options(allindb.executor.PRIORITY_HIGH).submit(
+        get_members
+    )
+    discord_future = executor.with_options(allindb.executor.PRIORITY_LOW).submit(
+        _update_discord_info_for_fetched_members, members_future
+    )
+
+    player_index = allindb.blizzard.PlayerIndex()
+    with metrics.stage("league_sweep"):
+        (
             mmrs_per_region,
             clan_members_per_region,
+        ) = allindb.blizzard.fetch_mmrs_and_clan_members_for_each_region(
             executor,
+            access_tokens_per_region,
+            current_season_id_per_region,
+            {"us": CLAN_IDS},
+            player_index,
+            LEAGUE_IDS,
+            SWEEP_CONCURRENCY_PER_REGION,
+        )
+
+    members = members_future.result()
+    _update_unregistered_members_with_all_members(
+        executor.map,
+        current_season_id_per_region,
+        mmrs_per_region,
+        clan_members_per_region,
+        members,
+    )
+    discord_future.result()
+
+    with metrics.stage("sweep_save"):
+        allindb.sweep.save(
+            SWEEP_OUTPUT_PATH,
+            current_season_id_per_region,
+            mmrs_per_region,
+            clan_members_per_region,
+            player_index,
+            members,
+        )
+    print("Saved sweep to " + SWEEP_OUTPUT_PATH)
+
+
+def _load_sweep(path: str, current_season_id_per_region: dict) -> tuple:
+    with metrics.stage("sweep_load"):
+        (
+            swept_season_id_per_region,
+            mmrs_per_region,
+            clan_members_per_region,
+            player_index,
+            members,
+        ) = allindb.sweep.load(path)
+
+    # Percentiles only make sense against the season that was swept.
+    current_season_id_per_region.update(swept_season_id_per_region)
+    print("Loaded sweep from {} for shard {}".format(path, SHARD))
+    return mmrs_per_region, clan_members_per_region, player_index, members
+
+
+def _checkpoint_sweep(
+    current_season_id_per_region: dict,
+    mmrs_per_region: dict,
+    clan_members_per_region: dict,
+    player_index: allindb.blizzard.PlayerIndex,
+):
+    if not journal.is_open:
+        return
+
+    with metrics.stage("sweep_save"):
+        allindb.sweep.save(
+            journal.sweep_path,
+            current_season_id_per_region,
+            mmrs_per_region,
+            clan_members_per_region,
+            player_index,
         )
+    journal.record_stage("league_sweep")
+
+
+def run_daemon():
+    stopping = threading.Event()
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signal_number, lambda *_: stopping.set())
+
+    # Tokens, HTTP sessions, the ladder and HTTP caches, the pool and the last
+    # sweep's MMR distributions and player index all stay warm between passes.
+    with allindb.executor.create_executor(
+        EXECUTOR, POOL_SIZE, MAX_PENDING
+    ) as task_executor:
+        executor = allindb.executor.InstrumentedExecutor(task_executor)
+        mmrs_per_region = None
+        known_member_keys = set()
+        next_sweep = 0.0
+
+        while not stopping.is_set():
+            # noinspection PyBroadException
+            try:
+                if mmrs_per_region is None or time.monotonic() >= next_sweep:
+                    next_sweep = time.monotonic() + SWEEP_INTERVAL
+                    (
+                        access_tokens_per_region,
+                        current_season_id_per_region,
+                    ) = _get_access_tokens_and_current_seasons()
+                    allindb.blizzard.ladder_cache.clear()
+                    mmrs_per_region, members, player_index = update(
+                        executor, access_tokens_per_region, current_season_id_per_region
+                    )
+                    known_member_keys = set(members.keys())
+                    print("Full update complete.")
+                else:
+                    known_member_keys = update_active_members(
+                        executor,
+                        access_tokens_per_region,
+                        current_season_id_per_region,
+                        mmrs_per_region,
+                        known_member_keys,
+                        player_index,
+                    )
+            except Exception:
+                traceback.print_exc()
+
+            write_metrics()
+            stopping.wait(
+                max(
+                    0.0,
+                    min(next_sweep, time.monotonic() + ACTIVE_MEMBER_INTERVAL)
+                    - time.monotonic(),
+                )
+            )
+
 
-        print("Updated unregistered members.")
+def main():
+    # Member tasks share futures, closures and in-memory indexes, so the
+    # process pool only takes the CPU bound work given to it below.
+    if EXECUTOR == "process":
+        sys.exit("EXECUTOR=process is not supported, use CPU_EXECUTOR=process")
+    if CPU_EXECUTOR:
+        allindb.blizzard.cpu_executor = allindb.executor.create_executor(
+            CPU_EXECUTOR, CPU_POOL_SIZE
+        )
+        # Fork the workers now, before any other thread has started.
+        allindb.blizzard.cpu_executor.submit(int).result()
+
+    allindb.blizzard.ladder_cache.max_size = LADDER_CACHE_SIZE
+    allindb.ratelimit.scheduler.set_max_concurrency(POOL_SIZE)
+    if HTTP_CACHE_PATH:
+        allindb.blizzard.http_cache = allindb.httpcache.HttpCache(HTTP_CACHE_PATH)
+        allindb.blizzard.http_cache.purge_expired(time.time())
+    metrics.enabled = bool(METRICS_PATH or PROMETHEUS_PATH)
+    if EXPORT_PATH:
+        # Writes go to a local file for upload_export.py to publish later,
+        # one per shard as with the journal.
+        allindb.firebase.sink = allindb.export.ExportSink(
+            "{}.shard-{}".format(EXPORT_PATH, SHARD.index)
+            if SHARD.count > 1
+            else EXPORT_PATH
+        )
+
+    if DAEMON:
+        run_daemon()
+        return
+
+    if ASYNC and not SWEEP_OUTPUT_PATH:
+        asyncio.run(main_async())
+        write_metrics()
+        return
+
+    (
+        access_tokens_per_region,
+        current_season_id_per_region,
+    ) = _get_access_tokens_and_current_seasons()
+
+    sweep = None
+    if not SWEEP_OUTPUT_PATH:
+        sweep = _open_run(current_season_id_per_region)
+
+    # The member and clan member work runs in the same pool as the sweep,
+    # whose tasks share the player index, ladder cache and rate limiter, so
+    # only thread and current thread executors fit here.
+    with allindb.executor.create_executor(
+        EXECUTOR, POOL_SIZE, MAX_PENDING
+    ) as task_executor:
+        executor = allindb.executor.InstrumentedExecutor(task_executor)
+        if SWEEP_OUTPUT_PATH:
+            sweep_only(
+                executor, access_tokens_per_region, current_season_id_per_region
+            )
+        else:
+            update(
+                executor,
+                access_tokens_per_region,
+                current_season_id_per_region,
+                sweep,
+            )
 
+    write_metrics()
     print("update complete.")
 
 
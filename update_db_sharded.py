@@ -0,0 +1,71 @@
+import json
+import os
+import subprocess
+import sys
+
+from allindb.metrics import metrics
+
+SHARDS = int(os.getenv("SHARDS", str(os.cpu_count() or 1)))
+SWEEP_PATH = os.getenv("SWEEP_PATH", "sweep.json.gz")
+METRICS_PATH = os.getenv("METRICS_PATH", "")
+PROMETHEUS_PATH = os.getenv("PROMETHEUS_PATH", "")
+UPDATE_DB = os.path.join(os.path.dirname(os.path.abspath(__file__)), "update_db.py")
+
+
+def _run_update_db(env: dict, metrics_path: str) -> subprocess.Popen:
+    env = dict(os.environ, **env)
+    env.update({"METRICS_PATH": metrics_path, "PROMETHEUS_PATH": ""})
+    return subprocess.Popen([sys.executable, UPDATE_DB], env=env)
+
+
+def _merge_metrics(metrics_path: str):
+    try:
+        with open(metrics_path) as metrics_file:
+            metrics.merge(json.load(metrics_file))
+    except (OSError, ValueError):
+        print("No metrics from " + metrics_path)
+        return
+    os.remove(metrics_path)
+
+
+def main():
+    # The sweep, along with the member read, the Discord sync and the
+    # unregistered members, runs once, then every shard reads it from the same
+    # file. Shards on other hosts can run update_db.py with SHARD=i/n and a
+    # copy of the file instead.
+    sweep_metrics_path = SWEEP_PATH + ".metrics.json"
+    if _run_update_db({"SWEEP_OUTPUT_PATH": SWEEP_PATH}, sweep_metrics_path).wait():
+        sys.exit("League sweep failed.")
+    _merge_metrics(sweep_metrics_path)
+
+    shard_metrics_paths = [
+        "{}.shard-{}.metrics.json".format(SWEEP_PATH, index) for index in range(SHARDS)
+    ]
+    shards = [
+        _run_update_db(
+            {
+                "SHARD": "{}/{}".format(index, SHARDS),
+                "SWEEP_PATH": SWEEP_PATH,
+                "SWEEP_OUTPUT_PATH": "",
+                "DAEMON": "false",
+            },
+            shard_metrics_paths[index],
+        )
+        for index in range(SHARDS)
+    ]
+    failed_shards = [index for index, shard in enumerate(shards) if shard.wait()]
+
+    for metrics_path in shard_metrics_paths:
+        _merge_metrics(metrics_path)
+    if METRICS_PATH:
+        metrics.write_json(METRICS_PATH)
+    if PROMETHEUS_PATH:
+        metrics.write_prometheus(PROMETHEUS_PATH)
+
+    if failed_shards:
+        sys.exit("Shards failed: " + ", ".join(map(str, failed_shards)))
+    print("Sharded update complete.")
+
+
+if __name__ == "__main__":
+    main()
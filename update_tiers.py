@@ -1,17 +1,21 @@
 import itertools
-import functools
 import json
 import os
 
-import sc2gamedata
 import firebase_admin
 import firebase_admin.credentials
 from firebase_admin.db import reference
 
+import allindb.blizzard
+import allindb.httpcache
+import allindb.tokens
+
 CLIENT_ID = os.getenv("BATTLE_NET_CLIENT_ID", "")
 CLIENT_SECRET = os.getenv("BATTLE_NET_CLIENT_SECRET", "")
 FIREBASE_CONFIG = json.loads(os.getenv("FIREBASE_CONFIG", {}))
 LEAGUE_IDS = range(7)
+HTTP_CACHE_PATH = os.getenv("HTTP_CACHE_PATH", "http_cache.sqlite")
+TOKEN_CACHE_PATH = os.getenv("TOKEN_CACHE_PATH", "token_cache.json")
 
 firebase_admin.initialize_app(
     credential=firebase_admin.credentials.Certificate(
@@ -21,42 +25,38 @@ firebase_admin.initialize_app(
 )
 
 
-def _flatten(l) -> list:
-    return list(itertools.chain.from_iterable(l))
-
-
 def _fetch_tier_boundaries_for_league(
-    access_token: str, current_season_id: int, league_id: int
+    access_token: str, current_season_id: int, region: str, league_id: int
 ) -> list:
-    league_data = sc2gamedata.get_league_data(
-        access_token, current_season_id, league_id
+    league_data = allindb.blizzard.get_league_data(
+        access_token, current_season_id, league_id, region
     )
-    return [
-        {
-            "type": "boundary",
-            "tier": (league_id * 3) + tier_index,
-            "min_mmr": tier_data.get("min_rating", 0),
-            "max_mmr": tier_data.get("max_rating", 99999),
-        }
-        for tier_index, tier_data in enumerate(reversed(league_data.get("tier", [])))
-    ]
+    return allindb.blizzard.extract_tier_boundaries(league_id, league_data)
 
 
 def main():
-    access_token, _ = sc2gamedata.get_access_token(CLIENT_ID, CLIENT_SECRET, "us")
-    season_id = sc2gamedata.get_current_season_data(access_token)["id"]
+    if HTTP_CACHE_PATH:
+        allindb.blizzard.http_cache = allindb.httpcache.HttpCache(HTTP_CACHE_PATH)
 
-    tier_boundaries = map(
-        functools.partial(_fetch_tier_boundaries_for_league, access_token, season_id),
-        LEAGUE_IDS,
-    )
-    flattened_tier_boundaries = _flatten(tier_boundaries)
-    keyed_tier_boundaries = dict((x["tier"], x) for x in flattened_tier_boundaries)
+    access_tokens, season_ids = allindb.tokens.TokenManager(
+        CLIENT_ID, CLIENT_SECRET, allindb.blizzard.REGIONS, TOKEN_CACHE_PATH
+    ).bootstrap()
 
+    # update_db writes these alongside each sweep; this refreshes them without
+    # running one.
     ref = firebase_admin.db.reference()
-    ref.child("tier_boundaries").child("us").child(str(season_id)).set(
-        keyed_tier_boundaries
-    )
+    for region, season_id in season_ids.items():
+        tier_boundaries = allindb.blizzard.TierBoundaries(
+            itertools.chain.from_iterable(
+                _fetch_tier_boundaries_for_league(
+                    access_tokens[region], season_id, region, league_id
+                )
+                for league_id in LEAGUE_IDS
+            )
+        )
+        ref.child("tier_boundaries").child(region).child(str(season_id)).set(
+            tier_boundaries.to_dict()
+        )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,38 @@
+import json
+import os
+
+import firebase_admin
+import firebase_admin.credentials
+
+import allindb.export
+from allindb.metrics import metrics
+
+FIREBASE_CONFIG = json.loads(os.getenv("FIREBASE_CONFIG", {}))
+EXPORT_PATH = os.getenv("EXPORT_PATH", allindb.export.EXPORT_PATH)
+BASELINE_PATH = os.getenv("BASELINE_PATH", allindb.export.BASELINE_PATH)
+UPLOAD_BATCH_SIZE = int(
+    os.getenv("UPLOAD_BATCH_SIZE", str(allindb.export.UPLOAD_BATCH_SIZE))
+)
+METRICS_PATH = os.getenv("METRICS_PATH", "")
+
+firebase_admin.initialize_app(
+    credential=firebase_admin.credentials.Certificate(
+        FIREBASE_CONFIG.get("serviceAccount", {})
+    ),
+    options=FIREBASE_CONFIG,
+)
+
+
+def main():
+    metrics.enabled = bool(METRICS_PATH)
+
+    with metrics.stage("upload"):
+        uploaded = allindb.export.upload(EXPORT_PATH, BASELINE_PATH, UPLOAD_BATCH_SIZE)
+    print("Uploaded {} changed paths.".format(uploaded))
+
+    if METRICS_PATH:
+        metrics.write_json(METRICS_PATH)
+
+
+if __name__ == "__main__":
+    main()